@@ -20,6 +20,13 @@ from typing import Union
 import re
 import os
 import base64
+import io
+import hashlib
+import sqlite3
+import threading
+import time
+import email
+from contextlib import closing
 
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
@@ -114,6 +121,8 @@ FULL_SPN_DATE_DICT = {
 }
 NUM_DATE_DICT = {m: i+1 for i, m in enumerate(SPN_DATE_DICT.values())}
 
+OUTBOX_PATH = 'outbox.db'
+
 #--------------------------------- Functions ----------------------------------#
 def clean_excel_file(file_path=None, df=None, skiprows=8, column_names=[], 
     drop_columns=None, as_percentage=None, subset_dropna=[],
@@ -432,7 +441,8 @@ def send_message(
         return None
 
 def create_message_with_attachment(sender: str, to: str, subject: str, 
-                                   body: str, file: str) -> dict:
+                                   body: str, file: Union[str, bytes, io.BytesIO],
+                                   filename: str = 'image1.png') -> dict:
     """Creates the message, with attachments and relevant information,
     which will be sent.
 
@@ -441,7 +451,12 @@ def create_message_with_attachment(sender: str, to: str, subject: str,
         to (str): Email(s) to which the message will be delivered. 
         subject (str): subject of the EMail
         body (str): body of the EMail
-        file (str): attached file to the email.
+        file (str, bytes, io.BytesIO): attached file to the email. It
+            can be a path, or an image already rendered in memory, such
+            as the buffer returned by irrbb.fig_to_buffer.
+        filename (str, optional): name given to the attachment when file
+            is an in-memory image. Its extension sets the image type.
+            Defaults to 'image1.png'.
 
     Returns:
         dict: dictionary with the decoded data from the message
@@ -459,47 +474,335 @@ def create_message_with_attachment(sender: str, to: str, subject: str,
     with open(body, 'r', encoding='utf-8') as f:
         msg = MIMEText(f.read(), format_dict[body_format])
     message.attach(msg)
-    if file:
-        (content_type, encoding) = mimetypes.guess_type(file)
-        
-        if content_type is None or encoding is not None:
-            content_type = 'application/octet-stream'
-        
-        (main_type, sub_type) = content_type.split('/', 1)
-        
-        if main_type == 'image':
-            with open(file, 'rb') as f:
-                msg = MIMEImage(f.read(), _subtype=sub_type)
-        else:
-            input_error = input("The file path passed isn't from image")
+    if isinstance(file, (bytes, io.BytesIO)):
+        message.attach(mime_inline_image(file, '<image1>', filename))
+    elif file:
+        message.attach(mime_inline_image(file, '<image1>'))
+
+    # Add boomerang: 
+    message.attach(mime_inline_image('dav-bom.png', '<image2>'))
     
-        filename = os.path.basename(file)
+    raw_msg = base64.urlsafe_b64encode(message.as_string().encode('utf-8'))
     
-        msg.add_header('Content-Id', '<image1>')
-        msg.add_header('Content-Disposition', 'inline', filename=filename)
-        message.attach(msg)
+    return {'raw': raw_msg.decode('utf-8')}
 
-    # Add boomerang: 
-    file2 = 'dav-bom.png'
-    (content_type, encoding) = mimetypes.guess_type(file2)
-        
+def mime_inline_image(file: Union[str, bytes, io.BytesIO], content_id: str,
+                      filename: str = None) -> MIMEImage:
+    """Builds the inline image part of an EMail, either from a file in
+    disk or from an image in memory.
+
+    Args:
+        file (str, bytes, io.BytesIO): path to the image, or the image
+            bytes.
+        content_id (str): Content-Id used to reference the image from
+            the HTML body, for example '<image1>'.
+        filename (str, optional): name of the attachment. If None, the
+            base name of the path is used. Defaults to None.
+
+    Returns:
+        MIMEImage: image part ready to be attached to the message.
+    """
+    if isinstance(filename, type(None)):
+        filename = os.path.basename(file)
+    (content_type, encoding) = mimetypes.guess_type(filename)
+    
     if content_type is None or encoding is not None:
         content_type = 'application/octet-stream'
     
     (main_type, sub_type) = content_type.split('/', 1)
     
-    if main_type == 'image':
-        with open(file2, 'rb') as f:
-            msg = MIMEImage(f.read(), _subtype=sub_type)
+    if main_type != 'image':
+        raise ValueError(f"The file passed isn't an image: {filename}")
+    if isinstance(file, io.BytesIO):
+        msg = MIMEImage(file.getvalue(), _subtype=sub_type)
+    elif isinstance(file, bytes):
+        msg = MIMEImage(file, _subtype=sub_type)
     else:
-        input_error = input("The file path passed isn't from image")
+        with open(file, 'rb') as f:
+            msg = MIMEImage(f.read(), _subtype=sub_type)
 
-    filename2 = os.path.basename(file2)
+    msg.add_header('Content-Id', content_id)
+    msg.add_header('Content-Disposition', 'inline', filename=filename)
+    return msg
 
-    msg.add_header('Content-Id', '<image2>')
-    msg.add_header('Content-Disposition', 'inline', filename=filename2)
-    message.attach(msg)
-    
-    raw_msg = base64.urlsafe_b64encode(message.as_string().encode('utf-8'))
-    
-    return {'raw': raw_msg.decode('utf-8')}
\ No newline at end of file
+def message_fingerprint(raw: str) -> str:
+    """Returns a hash of the content of a message that doesn't change
+    when the same message is built again: the recipients, the subject
+    and the type, name and bytes of each part, leaving out the MIME
+    boundaries.
+
+    Args:
+        raw (str): raw message, as returned by
+            create_message_with_attachment.
+
+    Returns:
+        str: SHA-256 hash of the content of the message.
+    """
+    msg = email.message_from_bytes(base64.urlsafe_b64decode(
+        raw.encode('utf-8')+b'='*(-len(raw)%4)))
+    content_hash = hashlib.sha256()
+    for header in ['from', 'to', 'cc', 'subject']:
+        content_hash.update(str(msg.get(header, '')).encode('utf-8')+b'\0')
+    for part in msg.walk():
+        if part.is_multipart():
+            continue
+        content_hash.update(part.get_content_type().encode('utf-8')+b'\0')
+        content_hash.update(str(part.get_filename('')).encode('utf-8')+b'\0')
+        content_hash.update(str(part.get('Content-ID', '')).encode('utf-8')
+                            +b'\0')
+        content_hash.update((part.get_payload(decode=True) or b'')+b'\0')
+    return content_hash.hexdigest()
+
+#---------------------------------- Classes ----------------------------------#
+class EmailOutbox(object):
+    """Persistent outbox for the EMails sent through the Gmail API. The
+    messages are stored in a SQLite file, so that the data run can
+    enqueue them and continue, while a background worker delivers them
+    with retries. Messages pending delivery stay in the file and are 
+    retried the next time a worker is started. Messages that failed 
+    max_attempts times are marked as failed; enqueuing them again, or
+    calling retry, puts them back in the queue.
+    """
+    def __init__(self, db_path: str = OUTBOX_PATH, user_id: str = 'me',
+                 max_attempts: int = 5, retry_delay: float = 30,
+                 poll_interval: float = 5, claim_timeout: float = 600):
+        """Initiates the EmailOutbox object.
+
+        Args:
+            db_path (str, optional): path to the SQLite file that stores
+                the outbox. Defaults to OUTBOX_PATH.
+            user_id (str, optional): ID of the user of the API. Defaults
+                to 'me'.
+            max_attempts (int, optional): number of delivery attempts
+                before a message is marked as failed. Defaults to 5.
+            retry_delay (float, optional): seconds waited after the first
+                failed attempt. The delay doubles after each new failure.
+                Defaults to 30.
+            poll_interval (float, optional): seconds the worker waits
+                between two reviews of the outbox. Defaults to 5.
+            claim_timeout (float, optional): seconds a message claimed by
+                a worker stays reserved. If the worker dies while
+                sending, the message is retried after this time.
+                Defaults to 600.
+        """
+        self.db_path = db_path
+        self.user_id = user_id
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.service = None
+        self._stop_event = threading.Event()
+        self._worker = None
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dedup_key TEXT UNIQUE NOT NULL,
+                    user_id TEXT NOT NULL,
+                    raw TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL,
+                    last_error TEXT,
+                    gmail_id TEXT,
+                    created_at REAL NOT NULL,
+                    sent_at REAL
+                )"""
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Opens a new connection to the outbox file. Each thread uses
+        its own connection."""
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def enqueue(self, message: dict, user_id: str = None,
+                dedup_key: str = None) -> int:
+        """Stores the message in the outbox and returns immediately. A
+        message with a dedup_key already stored is not enqueued again,
+        unless it failed: then it is queued for delivery again.
+
+        Args:
+            message (dict): message as returned by
+                create_message_with_attachment.
+            user_id (str, optional): ID of the user of the API. Defaults
+                to the user_id of the outbox.
+            dedup_key (str, optional): key that identifies the message,
+                for example the report name and date. Defaults to the
+                hash of the content of the message (see
+                message_fingerprint).
+
+        Returns:
+            int: ID of the message in the outbox.
+        """
+        if isinstance(user_id, type(None)):
+            user_id = self.user_id
+        if isinstance(dedup_key, type(None)):
+            dedup_key = message_fingerprint(message['raw'])
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """INSERT OR IGNORE INTO outbox
+                (dedup_key, user_id, raw, next_attempt, created_at)
+                VALUES (?, ?, ?, ?, ?)""",
+                (dedup_key, user_id, message['raw'], now, now)
+            )
+            conn.execute(
+                """UPDATE outbox SET status = 'pending', attempts = 0,
+                next_attempt = ?, last_error = NULL
+                WHERE dedup_key = ? AND status = 'failed'""",
+                (now, dedup_key)
+            )
+            message_id = conn.execute(
+                'SELECT id FROM outbox WHERE dedup_key = ?', (dedup_key,)
+            ).fetchone()[0]
+        return message_id
+
+    def retry(self, message_id: int = None) -> int:
+        """Queues failed messages for delivery again.
+
+        Args:
+            message_id (int, optional): ID of the message. If None, all
+                the failed messages are queued again. Defaults to None.
+
+        Returns:
+            int: number of messages queued again.
+        """
+        query = """UPDATE outbox SET status = 'pending', attempts = 0,
+            next_attempt = ?, last_error = NULL WHERE status = 'failed'"""
+        params = (time.time(),)
+        if not isinstance(message_id, type(None)):
+            query += ' AND id = ?'
+            params += (message_id,)
+        with closing(self._connect()) as conn, conn:
+            retried = conn.execute(query, params).rowcount
+        return retried
+
+    def status(self, message_id: int = None) -> pd.DataFrame:
+        """Returns the delivery status of the messages in the outbox.
+
+        Args:
+            message_id (int, optional): ID of the message. If None, the
+                status of all the messages is returned. Defaults to None.
+
+        Returns:
+            pd.DataFrame: status, attempts, last error and Gmail ID of
+                the messages.
+        """
+        query = """SELECT id, dedup_key, status, attempts, last_error,
+            gmail_id, created_at, sent_at FROM outbox"""
+        params = ()
+        if not isinstance(message_id, type(None)):
+            query += ' WHERE id = ?'
+            params = (message_id,)
+        with closing(self._connect()) as conn, conn:
+            status_df = pd.read_sql_query(query, conn, params=params)
+        for col in ['created_at', 'sent_at']:
+            status_df[col] = pd.to_datetime(status_df[col], unit='s')
+        return status_df.set_index('id')
+
+    def drain(self) -> int:
+        """Tries to deliver every message whose next attempt is due. Each
+        message is claimed before it is sent, so that several workers on
+        the same outbox file don't send it twice.
+
+        Returns:
+            int: number of messages delivered.
+        """
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                """SELECT id, user_id, raw, attempts FROM outbox
+                WHERE status IN ('pending', 'sending') AND next_attempt <= ?
+                ORDER BY id""",
+                (time.time(),)
+            ).fetchall()
+        if not rows:
+            return 0
+
+        if isinstance(self.service, type(None)):
+            try:
+                self.service = get_service()
+            except Exception as e:
+                print(f'Outbox: Gmail service not available: {e}')
+            if isinstance(self.service, type(None)):
+                return 0
+
+        sent = 0
+        for message_id, user_id, raw, attempts in rows:
+            now = time.time()
+            with closing(self._connect()) as conn, conn:
+                claimed = conn.execute(
+                    """UPDATE outbox SET status = 'sending',
+                    next_attempt = ? WHERE id = ? AND next_attempt <= ?
+                    AND status IN ('pending', 'sending')""",
+                    (now+self.claim_timeout, message_id, now)
+                ).rowcount
+            if not claimed:
+                continue
+            try:
+                result = self.service.users().messages().send(
+                    userId = user_id,
+                    body = {'raw': raw}).execute()
+            except Exception as e:
+                attempts += 1
+                status = 'failed' if attempts>=self.max_attempts \
+                    else 'pending'
+                next_attempt = time.time()+\
+                    self.retry_delay*2**(attempts-1)
+                with closing(self._connect()) as conn, conn:
+                    conn.execute(
+                        """UPDATE outbox SET status = ?, attempts = ?,
+                        next_attempt = ?, last_error = ? WHERE id = ?""",
+                        (status, attempts, next_attempt, str(e), message_id)
+                    )
+                print(f'Outbox: message {message_id} attempt {attempts} '
+                      f'failed: {e}')
+                continue
+
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    """UPDATE outbox SET status = 'sent', attempts = ?,
+                    gmail_id = ?, sent_at = ?, last_error = NULL
+                    WHERE id = ?""",
+                    (attempts+1, result.get('id'), time.time(), message_id)
+                )
+            sent += 1
+        return sent
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                print(f'Outbox: worker error: {e}')
+            self._stop_event.wait(self.poll_interval)
+
+    def start(self) -> threading.Thread:
+        """Starts the background worker that drains the outbox.
+
+        Returns:
+            threading.Thread: thread running the worker.
+        """
+        if isinstance(self._worker, type(None)) or \
+                not self._worker.is_alive():
+            self._stop_event.clear()
+            self._worker = threading.Thread(
+                target = self._run,
+                name = 'hal01-outbox',
+                daemon = True
+            )
+            self._worker.start()
+        return self._worker
+
+    def stop(self, timeout: float = None):
+        """Stops the background worker. Messages not yet delivered stay
+        in the outbox file.
+
+        Args:
+            timeout (float, optional): seconds to wait for the worker to
+                finish its current round. Defaults to None.
+        """
+        self._stop_event.set()
+        if not isinstance(self._worker, type(None)):
+            self._worker.join(timeout)
@@ -13,6 +13,12 @@ import matplotlib.pyplot as plt
 import matplotlib as mlp
 from scipy.interpolate import interp1d
 import os
+import io
+import copy
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from datetime import datetime
 from datetime import date
 from dateutil.relativedelta import relativedelta
@@ -29,6 +35,45 @@ COLORS = ['#c00000','#9d9d9c','#007179','#5e7493','#203864','#ffc000', '#70ad47'
           '#4472c4','#a2b9e2', '#2290ce', '#7030a0', '#0072ae', '#bf9737',
           '#1d1d1b']
 BUCKETS = ['O/N','1W','1M','3M','6M','9M','1Y','2Y','3Y','4Y','5Y','10Y','+10Y']
+# Upper limits (inclusive) of the buckets, in days from O/N and in months from
+# 1M, used by assign_buckets:
+DAY_EDGES = np.array([1,7,30,90,180,270,360,720,1080,1440,1800,3600])
+MONTH_EDGES = np.array([1,3,6,9,12,24,36,48,60,120])
+# Repricing period in days of each reference rate. The keys are normalized as
+# in vec_days_to_reprice (upper case, without spaces, '-' or '_'):
+REPRICE_PERIODS = {
+    'LIBOR1M': 30, 'LIBOR3M': 90, 'LIBOR6M': 180, 'LIBOR12M': 360,
+    'SOFR': 1, 'SOFRON': 1, 'SOFR1M': 30, 'SOFR3M': 90, 'SOFR6M': 180,
+    'SOFR12M': 360, 'TERMSOFR1M': 30, 'TERMSOFR3M': 90, 'TERMSOFR6M': 180,
+    'TERMSOFR12M': 360, 'IBR': 1, 'IBRON': 1, 'IBR1M': 30, 'IBR3M': 90,
+    'IBR6M': 180, 'IBR12M': 360
+}
+FLOW_COLUMNS = ['Periodos de Pago','Tasa Referencia','Flujos Capital']
+RATE_TENORS = {'IBR_ON': 1/360, 'TIBR': 1/360, 'IBR_1M': 1/12, 'IBR_3M': 0.25,
+               'DTF': 0.25, 'IBR_6M': 0.5, 'IBR_12M': 1.0}
+# Workbook formats that openpyxl can stream; other formats (.xls, .xlsb, ...)
+# are read whole with pandas.read_excel:
+OPENPYXL_EXTENSIONS = ('.xlsx', '.xlsm', '.xltx', '.xltm')
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.irrbb_cache')
+INTERPOLATOR_CACHE_SIZE = 256
+_INTERPOLATOR_CACHE = OrderedDict()
+_T_K_SHORT_PROFILE = np.exp(-T_K/4)
+ROTATION_COEFFICIENTS = {'steepner': (-0.65, 0.9), 'flattener': (0.8, -0.6)}
+# Shock sizes (parallel, short, long) in basis points, from the SRP31 table of
+# the BIS. COP, HNL and CRC are not in the table, so they keep the sizes that
+# were used for all the currencies.
+SRP31_SHOCKS = {
+    'ARS': (400,500,300), 'AUD': (300,450,200), 'BRL': (400,500,300),
+    'CAD': (200,300,150), 'CHF': (100,150,100), 'CNY': (250,300,150),
+    'EUR': (200,250,100), 'GBP': (250,300,150), 'HKD': (200,250,100),
+    'IDR': (400,500,350), 'INR': (400,500,300), 'JPY': (100,100,100),
+    'KRW': (300,400,200), 'MXN': (400,500,300), 'RUB': (400,500,300),
+    'SAR': (200,300,150), 'SEK': (200,300,150), 'SGD': (150,200,100),
+    'TRY': (400,500,300), 'USD': (200,300,150), 'ZAR': (400,500,300),
+    'COP': (200,300,150), 'HNL': (200,300,150), 'CRC': (200,300,150)
+}
+SCENARIOS = ['parallel_up','parallel_down','short_up','short_down','steepner',
+             'flattener']
 #------------------------------------------------------------------------------
 # 3. Fucntions
 def sim_yield_curve(beta_1=0.0175, beta_2=0.003, beta_3=0.02, lmbda=0.0609):
@@ -65,7 +110,174 @@ def sim_yield_curve(beta_1=0.0175, beta_2=0.003, beta_3=0.02, lmbda=0.0609):
     yield_curve = beta_1+short_term+medium_term
     return yield_curve
 
-def parallel_shock(yield_curve=None, r_shock=200, direction:int=1):
+def nelson_siegel_loadings(lmbda=0.0609, t_k=None):
+    """Computes the loadings of the three Nelson-Siegel factors (level,
+    slope and curvature) as in sim_yield_curve, so that a curve is the
+    product of the loadings and the betas.
+    
+    Inputs:
+    -------
+    lmbda: float/array (default = 0.0609)
+        Decay parameter. An array gives one set of loadings per value.
+    t_k: array (default = None)
+        Maturities. If None, T_K is used.
+    
+    Outputs:
+    --------
+    loadings: array ([lambdas x] len(t_k) x 3)
+        Loadings of beta_1, beta_2 and beta_3 for each maturity.
+    """
+    if isinstance(t_k, type(None)):
+        t_k = T_K
+    lt = np.asarray(lmbda, dtype=float)[...,None]*np.asarray(t_k, dtype=float)
+    slope = -np.expm1(-lt)/lt
+    curvature = slope-np.exp(-lt)
+    return np.stack([np.ones_like(lt), slope, curvature], axis=-1)
+
+def fit_nelson_siegel(rates, tenors=None, lmbda=0.0609):
+    """Fits the Nelson-Siegel betas of every date of a rate history by
+    least squares, as in Diebold & Li (2005). With a fixed lambda the
+    loadings are the same for all dates, so all the dates are solved
+    with one matrix operation (one per pattern of missing values).
+    
+    Inputs:
+    -------
+    rates: pandas DataFrame
+        Rates (as decimals) with dates as index and one column per 
+        instrument, for example the outputs of hal01.ibr_series.
+    tenors: dict (default = None)
+        Maturity in years of each column of rates. If None, RATE_TENORS
+        is used. Columns without tenor are ignored.
+    lmbda: float (default = 0.0609)
+        Decay parameter of the curve.
+    
+    Outputs:
+    --------
+    betas: pandas DataFrame
+        Columns beta_1, beta_2 and beta_3 for each date. Dates with
+        less than three observed rates are NaN.
+    """
+    if isinstance(tenors, type(None)):
+        tenors = RATE_TENORS
+    columns = [col for col in rates.columns if col in tenors]
+    Y = rates[columns].to_numpy(dtype=float)
+    X = nelson_siegel_loadings(lmbda, np.array([tenors[c] for c in columns]))
+    betas = np.full((len(Y), 3), np.nan)
+    observed = ~np.isnan(Y)
+    patterns, pattern_index = np.unique(observed, axis=0,
+                                        return_inverse=True)
+    for i, pattern in enumerate(patterns):
+        if pattern.sum() < 3:
+            continue
+        rows = pattern_index.ravel()==i
+        solution = np.linalg.lstsq(X[pattern], Y[rows][:,pattern].T,
+                                   rcond=None)[0]
+        betas[rows] = solution.T
+    return pd.DataFrame(betas, index=rates.index,
+                        columns=['beta_1','beta_2','beta_3'])
+
+def nelson_siegel_curves(betas, lmbda=0.0609, t_k=None):
+    """Builds the yield curves of a set of Nelson-Siegel betas.
+    
+    Inputs:
+    -------
+    betas: pandas DataFrame/array
+        Betas (beta_1, beta_2, beta_3) by row, as returned by 
+        fit_nelson_siegel.
+    lmbda: float (default = 0.0609)
+        Decay parameter of the curve.
+    t_k: array (default = None)
+        Maturities. If None, T_K is used.
+    
+    Outputs:
+    --------
+    curves: pandas DataFrame
+        Yield curve of each row on t_k. Each row can be passed as the
+        yield_curve of a BankingBook.
+    """
+    if isinstance(t_k, type(None)):
+        t_k = T_K
+    index = betas.index if isinstance(betas, pd.DataFrame) else None
+    curves = np.asarray(betas, dtype=float)@\
+        nelson_siegel_loadings(lmbda, t_k).T
+    return pd.DataFrame(curves, index=index, columns=t_k)
+
+def curve_fingerprint(yield_curve, t_k=None):
+    """Returns a hash that identifies a yield curve and its maturities."""
+    if isinstance(t_k, type(None)):
+        t_k = T_K
+    fingerprint = hashlib.sha1(np.ascontiguousarray(t_k, dtype=float)
+                               .tobytes())
+    fingerprint.update(np.ascontiguousarray(yield_curve, dtype=float)
+                       .tobytes())
+    return fingerprint.hexdigest()
+
+def curve_interpolator(yield_curve, t_k=None, kind='cubic'):
+    """Returns the interpolator of a yield curve. Interpolators are kept
+    in a cache keyed by the fingerprint of the curve, so the spline of a
+    curve is only built once.
+    
+    Inputs:
+    -------
+    yield_curve: array
+        Interest rates of each maturity.
+    t_k: array (default = None)
+        Maturities of the curve. If None, T_K is used.
+    kind: str (default = 'cubic')
+        Kind of interpolation, as in scipy's interp1d.
+    
+    Outputs:
+    --------
+    function: scipy interp1d
+        Interpolator of the curve. It accepts arrays of maturities.
+    """
+    if isinstance(t_k, type(None)):
+        t_k = T_K
+    key = (curve_fingerprint(yield_curve, t_k), kind)
+    if key in _INTERPOLATOR_CACHE:
+        _INTERPOLATOR_CACHE.move_to_end(key)
+        return _INTERPOLATOR_CACHE[key]
+    function = interp1d(t_k, np.array(yield_curve, dtype=float), kind=kind)
+    _INTERPOLATOR_CACHE[key] = function
+    if len(_INTERPOLATOR_CACHE) > INTERPOLATOR_CACHE_SIZE:
+        _INTERPOLATOR_CACHE.popitem(last=False)
+    return function
+
+def _short_profile(t_k=None):
+    """Returns the decay exp(-t/4) of the short-side shocks. The profile
+    of T_K is computed once and reused."""
+    if isinstance(t_k, type(None)):
+        return _T_K_SHORT_PROFILE
+    return np.exp(-np.asarray(t_k, dtype=float)/4)
+
+def _shift_curves(yield_curve, terms, out=None):
+    """Adds to the yield curve(s) the sum of scale*profile for each 
+    (scale, profile) term, broadcasting curve matrices against arrays of
+    scales, and writing into out when it is given."""
+    yield_curve = np.asarray(yield_curve, dtype=float)
+    terms = [(np.asarray(scale, dtype=float)[...,None], profile) 
+             for scale, profile in terms]
+    shape = np.broadcast_shapes(
+        yield_curve.shape, 
+        *[np.broadcast_shapes(scale.shape, np.shape(profile)) 
+          for scale, profile in terms]
+    )
+    if isinstance(out, type(None)):
+        out = np.empty(shape)
+    elif out.shape != shape:
+        raise ValueError(f'out must have shape {shape}, not {out.shape}.')
+    elif np.shares_memory(out, yield_curve) and out is not yield_curve:
+        yield_curve = yield_curve.copy()
+    if out is not yield_curve:
+        np.copyto(out, yield_curve)
+    for scale, profile in terms:
+        if scale.size == 1:
+            out += scale.item()*profile
+        else:
+            out += scale*profile
+    return out
+
+def parallel_shock(yield_curve=None, r_shock=200, direction:int=1, out=None):
     """Applies a parallel interest rate shock to the interest rate
     term structure.
     
@@ -73,12 +285,17 @@ def parallel_shock(yield_curve=None, r_shock=200, direction:int=1):
     -------
     yield_curve: array (default = None)
         Array of values that represent the interest rates for each 
-        of the middle points of the time buckets defined by the BIS.
-    r_shock: numerical value (default = 200)
-        Value in basis points of the shock to the term struture.
+        of the middle points of the time buckets defined by the BIS. It
+        can be a matrix with one curve per row.
+    r_shock: numerical value/array (default = 200)
+        Value in basis points of the shock to the term struture. An
+        array gives one value per curve.
     direction: integer (possible values: -1,1; default = 1)
         Direction of the shock to the term structure. 1 means an in-
         crease and -1 means a decrease in the term structure.
+    out: array (default = None)
+        Array where the result is written. It can be the yield curve
+        itself.
     
     Outputs:
     --------
@@ -87,11 +304,12 @@ def parallel_shock(yield_curve=None, r_shock=200, direction:int=1):
         shock.
     """
     if isinstance(yield_curve,type(None)):
-        yield_curve = np.zeros(19)
-    new_yc = yield_curve+direction*r_shock*1e-4
-    return new_yc
+        yield_curve = np.zeros(len(T_K))
+    scale = direction*np.asarray(r_shock, dtype=float)*1e-4
+    return _shift_curves(yield_curve, [(scale, 1.0)], out)
 
-def short_shock(yield_curve, r_shock=300, direction:int=1):
+def short_shock(yield_curve, r_shock=300, direction:int=1, t_k=None, 
+                out=None):
     """Applies a shock to the short side of the interest rate term 
     structure.
     
@@ -99,12 +317,19 @@ def short_shock(yield_curve, r_shock=300, direction:int=1):
     -------
     yield_curve: array
         Array of values that represent the interest rates for each 
-        of the middle points of the time buckets defined by the BIS.
-    r_shock: numerical value (default = 300)
-        Value in basis points of the shock to the term struture.
+        of the middle points of the time buckets defined by the BIS. It
+        can be a matrix with one curve per row.
+    r_shock: numerical value/array (default = 300)
+        Value in basis points of the shock to the term struture. An
+        array gives one value per curve.
     direction: integer (possible values: -1,1; default = 1)
         Direction of the shock to the term structure. 1 means an in-
         crease and -1 means a decrease in the term structure.
+    t_k: array (default = None)
+        Maturities of the curve. If None, T_K is used.
+    out: array (default = None)
+        Array where the result is written. It can be the yield curve
+        itself.
     
     Outputs:
     --------
@@ -112,12 +337,11 @@ def short_shock(yield_curve, r_shock=300, direction:int=1):
         Array of values that represent the yield curve after the
         shock.    
     """
-    shock = direction*r_shock*1e-4*np.exp(-T_K/4)
-    new_yc = yield_curve+shock
-    return new_yc
+    scale = direction*np.asarray(r_shock, dtype=float)*1e-4
+    return _shift_curves(yield_curve, [(scale, _short_profile(t_k))], out)
 
 def rotation_shock(yield_curve=None,short_shock=300, long_shock=150, 
-                   direction:str='steepner'):
+                   direction:str='steepner', t_k=None, out=None):
     """Applies a rotation shock to the interest rate term structure,
     either steepening or flattening it.
     
@@ -125,17 +349,23 @@ def rotation_shock(yield_curve=None,short_shock=300, long_shock=150,
     -------
     yield_curve: array
         Array of values that represent the interest rates for each 
-        of the middle points of the time buckets defined by the BIS.
-    short_shock: numerical value (default = 300)
+        of the middle points of the time buckets defined by the BIS. It
+        can be a matrix with one curve per row.
+    short_shock: numerical value/array (default = 300)
         Value in basis points of the shock to the short side of the term
         struture.
-    long_shock: numerical value (default = 150)
+    long_shock: numerical value/array (default = 150)
         Value in basis points of the shock to the long side of the term
         structure.
     direction: integer (default = 'steepner')
         Direction of the shock to the term structure. There are two pos-
         sible values, 'steepner', that makes more steep the curve and
         'flattener' that makes more flat the curve
+    t_k: array (default = None)
+        Maturities of the curve. If None, T_K is used.
+    out: array (default = None)
+        Array where the result is written. It can be the yield curve
+        itself.
     
     Outputs:
     --------
@@ -143,15 +373,427 @@ def rotation_shock(yield_curve=None,short_shock=300, long_shock=150,
         Array of values that represent the yield curve after the
         shock.    
     """
-    delta_short = short_shock*1e-4*np.exp(-T_K/4)
-    delta_long = long_shock*1e-4*(1-np.exp(-T_K/4))
+    if direction not in ROTATION_COEFFICIENTS:
+        raise ValueError(f"direction must be one of "
+                         f"{list(ROTATION_COEFFICIENTS)}, not {direction!r}.")
+    short_coef, long_coef = ROTATION_COEFFICIENTS[direction]
+    profile = _short_profile(t_k)
+    if isinstance(yield_curve, type(None)):
+        yield_curve = np.zeros(len(profile))
+    return _shift_curves(yield_curve, [
+        (short_coef*np.asarray(short_shock, dtype=float)*1e-4, profile),
+        (long_coef*np.asarray(long_shock, dtype=float)*1e-4, 1-profile)
+    ], out)
+
+def scenario_shifts(r_shock=200, short_shock=300, long_shock=150, t_k=None):
+    """Builds the interest rate shifts of the six BIS shocks as one
+    matrix, in the order of the global variable SCENARIOS.
+    
+    Inputs:
+    -------
+    r_shock: numerical value/array (default = 200)
+        Value of the parallel shock in basis points.
+    short_shock: numerical value/array (default = 300)
+        Value of the short-side shock in basis points.
+    long_shock: numerical value/array (default = 150)
+        Value of the long-side shock in basis points.
+    t_k: array (default = None)
+        Maturities of the term structure. If None, T_K is used.
+    
+    Outputs:
+    --------
+    shifts: array (6 x len(t_k))
+        Shift of each maturity for each shock. If the shock sizes are
+        arrays (one value per portfolio), the shape is (portfolios x 6 x
+        len(t_k)).
+    """
+    short_factor = _short_profile(t_k)
+    parallel, delta_short, delta_long = np.broadcast_arrays(
+        np.asarray(r_shock, dtype=float)[...,None]*1e-4,
+        np.asarray(short_shock, dtype=float)[...,None]*1e-4*short_factor,
+        np.asarray(long_shock, dtype=float)[...,None]*1e-4*(1-short_factor)
+    )
+    steep_short, steep_long = ROTATION_COEFFICIENTS['steepner']
+    flat_short, flat_long = ROTATION_COEFFICIENTS['flattener']
+    shifts = np.stack([
+        parallel,
+        -parallel,
+        delta_short,
+        -delta_short,
+        steep_short*delta_short+steep_long*delta_long,
+        flat_short*delta_short+flat_long*delta_long
+    ], axis=-2)
+    return shifts
+
+def shocked_curves(yield_curve, shifts, floor=None):
+    """Applies a set of shifts to one or many yield curves, with an
+    optional post-shock floor.
+    
+    Inputs:
+    -------
+    yield_curve: array (buckets) or (portfolios x buckets)
+        Interest rates of each time bucket.
+    shifts: array ([portfolios x] scenarios x buckets)
+        Shift of the yield curve for each scenario.
+    floor: array (default = None)
+        Post-shock floor of each maturity. A shocked rate can't be below
+        the floor, unless the observed rate already is, in which case
+        the observed rate is the floor. If None, no floor is applied.
+    
+    Outputs:
+    --------
+    curves: array ([portfolios x] scenarios x buckets)
+        Shocked yield curves.
+    """
+    base = np.asarray(yield_curve, dtype=float)[...,None,:]
+    curves = base+shifts
+    if not isinstance(floor, type(None)):
+        curves = np.maximum(curves, np.minimum(floor, base))
+    return curves
+
+def eve_engine(gap, t_k, yield_curve, shifts, floor=None):
+    """Computes the variation of the Economic Value of Equity of a set
+    of gaps for several shocks at once, discounting all the shocked
+    curves with one broadcast operation.
+    
+    Inputs:
+    -------
+    gap: array (buckets) or (portfolios x buckets)
+        Gap (assets-liabilities) of each time bucket.
+    t_k: array
+        Maturity of each time bucket, in years.
+    yield_curve: array (buckets) or (portfolios x buckets)
+        Interest rates of each time bucket.
+    shifts: array (scenarios x buckets) or (portfolios x scenarios x 
+        buckets)
+        Shift of the yield curve for each scenario, as returned by
+        scenario_shifts.
+    floor: array (default = None)
+        Post-shock floor of each maturity, as in shocked_curves.
+    
+    Outputs:
+    --------
+    delta_buckets: array ([portfolios x] scenarios x buckets)
+        Variation of the present value of the gap of each bucket.
+    delta_eve: array ([portfolios x] scenarios)
+        Total variation of the EVE for each scenario.
+    """
+    gap = np.asarray(gap, dtype=float)[...,None,:]
+    t_k = np.asarray(t_k, dtype=float)
+    base = np.asarray(yield_curve, dtype=float)[...,None,:]
+    shocked = shocked_curves(yield_curve, shifts, floor)
+    curves = np.concatenate(
+        [np.broadcast_to(base, shocked.shape[:-2]+base.shape[-2:]), shocked],
+        axis=-2
+    )
+    pv_gap = gap*(1+curves)**-t_k
+    delta_buckets = pv_gap[...,1:,:]-pv_gap[...,:1,:]
+    return delta_buckets, delta_buckets.sum(axis=-1)
+
+def key_rate_sensitivities(gap, t_k, yield_curve):
+    """Computes in closed form the first and second derivatives of the
+    present value of each gap, gap/(1+y_k)**t_k, with respect to the 
+    rate of its own node of the curve.
+    
+    Inputs:
+    -------
+    gap: array (..., buckets)
+        Gap (assets-liabilities) of each time bucket.
+    t_k: array (buckets)
+        Maturity of each time bucket, in years.
+    yield_curve: array (..., buckets)
+        Interest rates of each time bucket.
+    
+    Outputs:
+    --------
+    pv_gap: array (..., buckets)
+        Present value of each gap.
+    delta: array (..., buckets)
+        First derivative of the present value of each gap.
+    gamma: array (..., buckets)
+        Second derivative of the present value of each gap.
+    """
+    gap = np.asarray(gap, dtype=float)
+    t_k = np.asarray(t_k, dtype=float)
+    growth = 1+np.asarray(yield_curve, dtype=float)
+    pv_gap = gap*growth**-t_k
+    delta = -t_k*pv_gap/growth
+    gamma = t_k*(t_k+1)*pv_gap/growth**2
+    return pv_gap, delta, gamma
+
+def approx_delta_eve(delta, gamma, shifts):
+    """Approximates the variation of the EVE of any shift of the curve
+    with the key rate sensitivities (second order Taylor expansion).
+    
+    Inputs:
+    -------
+    delta: array ([portfolios x] buckets)
+        First derivatives returned by key_rate_sensitivities.
+    gamma: array ([portfolios x] buckets)
+        Second derivatives returned by key_rate_sensitivities. If None,
+        only the first order term is used.
+    shifts: array ([scenarios x] buckets)
+        Shifts of the curve, in decimals.
+    
+    Outputs:
+    --------
+    delta_eve: array ([portfolios x] [scenarios])
+        Approximated variation of the EVE.
+    """
+    shifts = np.asarray(shifts, dtype=float)
+    delta_eve = np.asarray(delta, dtype=float)@shifts.T
+    if not isinstance(gamma, type(None)):
+        delta_eve = delta_eve+0.5*np.asarray(gamma, dtype=float)@(shifts**2).T
+    return delta_eve
+
+def nii_engine(gap, t_k, curves, T=1, T_rate=None, pv=True,
+               constant_balance=False):
+    """Computes the Net Interest Income of each time bucket for many
+    yield curves at once, in the same way as BankingBook.calculate_nii.
+    
+    Inputs:
+    -------
+    gap: array (..., buckets)
+        Gap (assets-liabilities) of each time bucket.
+    t_k: array (buckets)
+        Maturity of each time bucket, in years. The curves are defined
+        on these maturities.
+    curves: array (..., buckets)
+        Yield curves. Leading dimensions broadcast against gap.
+    T: numerical value (default = 1)
+        The time horizon in which the NII will be computed, in years.
+    T_rate: numerical value/array (default = None)
+        Interest rate at the horizon for each curve. If None, it is
+        obtained by cubic interpolation of each curve.
+    pv: Boolean (default = True)
+        Determines whether we bring the values present value or not.
+    constant_balance: Boolean (default = False)
+        If True, the gap that reprices at t_k is renewed at the rate of
+        its own bucket until the horizon (constant balance sheet), 
+        instead of being taken to T at the forward rate between t_k and
+        T.
+    
+    Outputs:
+    --------
+    nii: array (..., buckets)
+        Net Interest Income of each bucket. Buckets with maturity 
+        beyond T are zero.
+    """
+    gap = np.asarray(gap, dtype=float)
+    t_k = np.asarray(t_k, dtype=float)
+    curves = np.asarray(curves, dtype=float)
+    if isinstance(T_rate, type(None)):
+        T_rate = interp1d(t_k, curves, kind='cubic', axis=-1)(T)
+    iT_rate = np.log1p(np.asarray(T_rate, dtype=float))[...,None]
+    log_curves = np.log1p(curves)
+    if constant_balance:
+        nii = gap*np.expm1(log_curves*(T-t_k))
+    else:
+        nii = gap*np.expm1(iT_rate*T-log_curves*t_k)
+    if pv:
+        nii = nii*np.exp(-iT_rate*T)
+    return np.where(t_k<=T, nii, 0.0)
+
+def interpolation_weights(T, t_k=None, kind='cubic'):
+    """Returns the weights that give the interpolated rate at T of any
+    curve on t_k as a dot product. Spline interpolation is linear in the
+    curve, so this replaces building one interpolator per curve.
+    
+    Inputs:
+    -------
+    T: numerical value/array
+        Maturities where the curves are interpolated, in years.
+    t_k: array (default = None)
+        Maturities of the curves. If None, T_K is used.
+    kind: str (default = 'cubic')
+        Kind of interpolation, as in scipy's interp1d.
+    
+    Outputs:
+    --------
+    weights: array (len(t_k)) or (len(t_k) x len(T))
+        Interpolation weights. curves@weights gives the rates at T.
+    """
+    if isinstance(t_k, type(None)):
+        t_k = T_K
+    n = len(t_k)
+    weights = interp1d(t_k, np.eye(n), kind=kind, axis=0)(T)
+    return weights
+
+def backtest_irrbb(curves, gaps, t_k=None, r_shock=200, short_shock=300,
+                   long_shock=150, currency=None, pv=True, T=1, 
+                   chunk_size=5000, path=None):
+    """Computes the base EVE, the EVE under the six BIS shocks and the
+    NII for every date of a history, processing the dates in vectorized
+    chunks.
+    
+    Inputs:
+    -------
+    curves: pandas DataFrame (dates x buckets)
+        Yield curve of each date, for example the output of 
+        nelson_siegel_curves.
+    gaps: pandas DataFrame/array (dates x buckets)
+        Gap (assets-liabilities) of each time bucket for each date, in 
+        the same order as curves. A single row is used for all dates.
+    t_k: array (default = None)
+        Maturities of the time buckets. If None, T_K is used.
+    r_shock: numerical value (default = 200)
+        Value of the parallel shock in basis points.
+    short_shock: numerical value (default = 300)
+        Value of the short-side shock in basis points.
+    long_shock: numerical value (default = 150)
+        Value of the long-side shock in basis points.
+    currency: str (default = None)
+        If given, the shocks and the floor of the currency in
+        SHOCK_REGISTRY are used instead of the shock sizes.
+    pv: Boolean (default = True)
+        Determines whether the NII is brought to present value.
+    T: numerical value (default = 1)
+        Horizon of the NII, in years.
+    chunk_size: int (default = 5000)
+        Number of dates computed at once.
+    path: str (default = None)
+        CSV file where the results are written chunk by chunk. If None,
+        the results are returned as a DataFrame.
+    
+    Outputs:
+    --------
+    results: pandas DataFrame/str
+        EVE, EVE of each scenario (EVE_<scenario>) and NII by date, or 
+        the path of the CSV file if path was given.
+    """
+    if isinstance(t_k, type(None)):
+        t_k = T_K
+    t_k = np.asarray(t_k, dtype=float)
+    shifts, floor = SHOCK_REGISTRY.scenario(currency, r_shock, short_shock,
+                                            long_shock, t_k)
+    index = curves.index if isinstance(curves, pd.DataFrame) else None
+    curves = np.asarray(curves, dtype=float)
+    gaps = np.atleast_2d(np.asarray(gaps, dtype=float))
+    weights_T = interpolation_weights(T, t_k)
+    columns = ['EVE']+['EVE_'+scenario for scenario in SCENARIOS]+['NII']
+    
+    results = []
+    for start in range(0, len(curves), chunk_size):
+        stop = min(start+chunk_size, len(curves))
+        curve = curves[start:stop]
+        gap = gaps[start:stop] if len(gaps)>1 else gaps
+        shocked = shocked_curves(curve, shifts, floor)
+        eve = np.column_stack([
+            (gap*(1+curve)**-t_k).sum(axis=1),
+            (gap[:,None,:]*(1+shocked)**-t_k).sum(axis=2)
+        ])
+        nii = nii_engine(gap, t_k, curve, T, curve@weights_T, pv).sum(axis=1)
+        chunk = pd.DataFrame(
+            np.column_stack([eve, nii]),
+            index = None if isinstance(index, type(None)) else 
+                index[start:stop],
+            columns = columns
+        )
+        if isinstance(path, type(None)):
+            results.append(chunk)
+        else:
+            chunk.to_csv(path, mode='w' if start==0 else 'a', 
+                         header=start==0)
+    if not isinstance(path, type(None)):
+        return path
+    return pd.concat(results)
+
+def _init_sweep_worker(gap, t_k, yield_curve, T_rate, weights_T, T, pv):
+    """Stores the arrays of the banking book in the worker process, as
+    read-only arrays shared by all the blocks it computes."""
+    global _SWEEP_DATA
+    arrays = [np.array(a, dtype=float) for a in 
+              [gap, t_k, yield_curve, weights_T]]
+    for a in arrays:
+        a.setflags(write=False)
+    _SWEEP_DATA = dict(zip(['gap','t_k','yield_curve','weights_T'], arrays))
+    _SWEEP_DATA.update({'T_rate': T_rate, 'T': T, 'pv': pv})
+
+def _sweep_block(block):
+    """Computes the variation of the EVE and the NII of the six shocks
+    for a block of (r_shock, short_shock, long_shock) grid points."""
+    data = _SWEEP_DATA
+    shifts = scenario_shifts(block[:,0], block[:,1], block[:,2], data['t_k'])
+    _, delta_eve = eve_engine(data['gap'], data['t_k'], data['yield_curve'],
+                              shifts)
+    curves = np.concatenate([
+        np.broadcast_to(data['yield_curve'], (len(block),1,len(data['t_k']))),
+        data['yield_curve']+shifts
+    ], axis=1)
+    rates = data['T_rate']+curves@data['weights_T']-\
+        data['yield_curve']@data['weights_T']
+    nii = nii_engine(data['gap'], data['t_k'], curves, data['T'], rates,
+                     data['pv']).sum(axis=-1)
+    return delta_eve, nii[:,1:]-nii[:,:1]
 
-    if direction == 'steepner':
-        new_yc = (-0.65*delta_short+0.9*delta_long)+yield_curve
-    elif direction == 'flattener':
-        new_yc = (0.8*delta_short-0.6*delta_long)+yield_curve
+def sweep_shocks(bb, r_shocks=(200,), short_shocks=(300,), long_shocks=(150,),
+                 pv=True, T=1, T_rate=None, block_size=2000, processes=None):
+    """Computes the variation of the EVE and the NII of the six BIS
+    shocks for every point of a grid of shock sizes. The grid is split
+    in vectorized blocks that are spread across a pool of processes.
     
-    return new_yc
+    Inputs:
+    -------
+    bb: BankingBook
+        Banking book evaluated.
+    r_shocks: array (default = (200,))
+        Values of the parallel shock in basis points.
+    short_shocks: array (default = (300,))
+        Values of the short-side shock in basis points.
+    long_shocks: array (default = (150,))
+        Values of the long-side shock in basis points.
+    pv: Boolean (default = True)
+        Determines whether the NII is brought to present value.
+    T: numerical value (default = 1)
+        Horizon of the NII, in years.
+    T_rate: numerical value (default = None)
+        Interest rate at the horizon. If None, it is interpolated from
+        the yield curve of the banking book.
+    block_size: int (default = 2000)
+        Number of grid points computed at once by a worker.
+    processes: int (default = None)
+        Number of processes. If None, the number of cores is used. With
+        1 the grid is computed in the current process.
+    
+    Outputs:
+    --------
+    cube: pandas DataFrame
+        Delta_EVE and Delta_NII indexed by r_shock, short_shock, 
+        long_shock and scenario.
+    """
+    t_k = bb.bb_al['t_k'].to_numpy(dtype=float)
+    yield_curve = np.asarray(bb.yield_curve, dtype=float)
+    weights_T = interpolation_weights(T, t_k)
+    if isinstance(T_rate, type(None)):
+        T_rate = yield_curve@weights_T
+    grid = pd.MultiIndex.from_product(
+        [r_shocks, short_shocks, long_shocks],
+        names = ['r_shock','short_shock','long_shock']
+    )
+    points = np.array(grid.to_list(), dtype=float).reshape(-1,3)
+    blocks = [points[i:i+block_size] 
+              for i in range(0, len(points), block_size)]
+    initargs = (bb.bb_al['gap'].to_numpy(dtype=float), t_k, yield_curve,
+                float(T_rate), weights_T, T, pv)
+    if isinstance(processes, type(None)):
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(blocks))
+    if processes <= 1:
+        _init_sweep_worker(*initargs)
+        outputs = [_sweep_block(block) for block in blocks]
+    else:
+        with ProcessPoolExecutor(
+                max_workers = processes,
+                initializer = _init_sweep_worker,
+                initargs = initargs) as executor:
+            outputs = list(executor.map(_sweep_block, blocks))
+    delta_eve = np.concatenate([output[0] for output in outputs])
+    delta_nii = np.concatenate([output[1] for output in outputs])
+    columns = pd.Index(SCENARIOS, name='scenario')
+    return pd.concat({
+        'Delta_EVE': pd.DataFrame(delta_eve, grid, columns).stack(),
+        'Delta_NII': pd.DataFrame(delta_nii, grid, columns).stack()
+    }, axis=1)
 
 def get_trm_series(limit=500):
     """Call from the SFC API Socrata the historical information of the 
@@ -232,6 +874,278 @@ def save_fig(fig_id, tight_layout=True, fig_extention='png', resolution=300):
         plt.tight_layout()
     plt.savefig(path, format=fig_extention, dpi=resolution)
 
+def fig_to_buffer(fig=None, tight_layout=True, fig_extention='png',
+                  resolution=150):
+    """Renders the figure into an in-memory buffer instead of a file,
+    so that it can be attached to an EMail without touching the disk.
+    
+    Inputs:
+    -------
+    fig: matplotlib Figure (default = None)
+        Figure to be rendered. If None, the current figure is used.
+    tight_layout: Boolean (default = True)
+        If True, applies the tight layout to the figure before rendering.
+    fig_extention: str (default = 'png')
+        Format of the rendered image.
+    resolution: int (default = 150)
+        Dots per inch of the image. A lower resolution than save_fig is
+        enough for the EMail reports.
+    
+    Outputs:
+    --------
+    buffer: io.BytesIO
+        Buffer with the rendered image, positioned at its beginning.
+    """
+    if isinstance(fig, type(None)):
+        fig = plt.gcf()
+    if tight_layout:
+        fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fig_extention, dpi=resolution)
+    buffer.seek(0)
+    return buffer
+
+def _init_chart_worker(style='seaborn', figsize=(10,6)):
+    """Prepares a chart rendering process: sets the Agg backend and the
+    style, and creates the figure and axes reused by every chart the
+    process renders. figsize is the size of the charts whose spec 
+    doesn't have one."""
+    global _WORKER_FIG, _WORKER_AX, _WORKER_FIGSIZE
+    plt.switch_backend('Agg')
+    mlp.style.use(style)
+    _WORKER_FIGSIZE = figsize
+    _WORKER_FIG, _WORKER_AX = plt.subplots(figsize=figsize)
+
+def _render_chart(spec, fig_extention='png', resolution=150):
+    """Draws one chart spec on the figure of the worker and returns the
+    rendered image as bytes."""
+    fig, ax = _WORKER_FIG, _WORKER_AX
+    ax.clear()
+    fig.set_size_inches(spec.get('figsize', _WORKER_FIGSIZE))
+    series = spec['series']
+    if isinstance(series, pd.DataFrame):
+        series = {col: series[col] for col in series.columns}
+    colors = spec.get('colors', COLORS)
+    kind = spec.get('kind', 'line')
+    width = 0.8/max(len(series), 1)
+    for i, (label, values) in enumerate(series.items()):
+        if 'x' in spec:
+            x = np.asarray(spec['x'])
+        elif isinstance(values, pd.Series):
+            x = values.index.values
+        else:
+            x = np.arange(len(values))
+        color = colors[i%len(colors)]
+        if kind == 'bar':
+            positions = np.arange(len(x))+(i-(len(series)-1)/2)*width
+            ax.bar(positions, np.asarray(values), width=width, color=color,
+                   label=label)
+            ax.set_xticks(np.arange(len(x)))
+            ax.set_xticklabels(x)
+        else:
+            ax.plot(x, np.asarray(values), color=color, label=label)
+    ax.set_title(spec.get('title', ''))
+    ax.set_xlabel(spec.get('xlabel', ''))
+    ax.set_ylabel(spec.get('ylabel', ''))
+    if len(series) > 1 or spec.get('legend', False):
+        ax.legend()
+    buffer = fig_to_buffer(fig, fig_extention=fig_extention,
+                           resolution=resolution)
+    return buffer.getvalue()
+
+def render_charts(specs, processes=None, fig_extention='png', resolution=150,
+                  style='seaborn', figsize=(10,6)):
+    """Renders a batch of charts in a pool of processes using the Agg
+    backend. Each process reuses a single figure for all the charts it
+    draws.
+    
+    Inputs:
+    -------
+    specs: list of dicts
+        Chart specifications. Each one has the keys:
+            series: dict/pandas DataFrame. Values to plot by label. 
+                pandas Series use their index as x axis.
+            x: array (optional). Values of the x axis.
+            kind: str (optional, default = 'line'). 'line' or 'bar'.
+            colors: list (optional, default = COLORS).
+            title, xlabel, ylabel: str (optional).
+            figsize: tuple (optional, default = (10,6)).
+            legend: Boolean (optional). Forces the legend for a single
+                series.
+    processes: int (default = None)
+        Number of processes. If None, the number of cores is used.
+    fig_extention: str (default = 'png')
+        Format of the rendered images.
+    resolution: int (default = 150)
+        Dots per inch of the images.
+    style: str (default = 'seaborn')
+        Matplotlib style used by the workers.
+    figsize: tuple (default = (10,6))
+        Size of the figure created in each worker.
+    
+    Outputs:
+    --------
+    images: list of bytes
+        Rendered images, in the same order as specs. They can be passed
+        directly to hal01.create_message_with_attachment.
+    """
+    specs = list(specs)
+    if not specs:
+        return []
+    if isinstance(processes, type(None)):
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(specs))
+    chunksize = max(1, len(specs)//(processes*4))
+    with ProcessPoolExecutor(
+            max_workers = processes,
+            initializer = _init_chart_worker,
+            initargs = (style, figsize)) as executor:
+        images = list(executor.map(
+            partial(_render_chart, fig_extention=fig_extention,
+                    resolution=resolution),
+            specs,
+            chunksize = chunksize
+        ))
+    return images
+
+def file_hash(path, chunk_size=1<<20):
+    """Returns the SHA-256 hash of the content of a file."""
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+def read_workbook(path, kwargs, cache_dir=None, reader=None):
+    """Reads a sheet of an Excel workbook. It is a module function so 
+    that it can run in a pool of processes.
+    
+    If a cache directory is given, the parsed sheet is stored there as a
+    pickled DataFrame, keyed by the path and the read arguments, with the
+    size, modification time and content hash of the workbook. Later
+    reads load the cached frame when the size and modification time 
+    match, or when the content hash does (for example, a copied file).
+    
+    Inputs:
+    -------
+    path: str
+        Path of the workbook.
+    kwargs: dict
+        Arguments passed to pandas.read_excel.
+    cache_dir: str (default = None)
+        Directory of the parsed-input cache. If None, no cache is used.
+    reader: function (default = None)
+        Function called as reader(path, **kwargs) to parse the sheet. If
+        None, pandas.read_excel is used.
+    
+    Outputs:
+    --------
+    df: pandas DataFrame
+        Sheet read.
+    """
+    if isinstance(reader, type(None)):
+        reader = pd.read_excel
+    if isinstance(cache_dir, type(None)):
+        return reader(path, **kwargs)
+
+    key = hashlib.sha1(repr((os.path.abspath(path), sorted(kwargs.items()),
+                             reader.__name__)).encode('utf-8')).hexdigest()
+    frame_path = os.path.join(cache_dir, key+'.pkl')
+    meta_path = os.path.join(cache_dir, key+'.meta.pkl')
+    size, mtime = os.stat(path).st_size, os.stat(path).st_mtime_ns
+    meta = None
+    if os.path.exists(frame_path) and os.path.exists(meta_path):
+        meta = pd.read_pickle(meta_path)
+        if meta['size'] == size and meta['mtime'] == mtime:
+            return pd.read_pickle(frame_path)
+    content_hash = file_hash(path)
+    if not isinstance(meta, type(None)) and meta['hash'] == content_hash:
+        df = pd.read_pickle(frame_path)
+    else:
+        df = reader(path, **kwargs)
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f'{frame_path}.{os.getpid()}.tmp'
+        df.to_pickle(temp_path)
+        os.replace(temp_path, frame_path)
+    meta = {'path': os.path.abspath(path), 'kwargs': kwargs, 'size': size, 
+            'mtime': mtime, 'hash': content_hash}
+    temp_path = f'{meta_path}.{os.getpid()}.tmp'
+    pd.to_pickle(meta, temp_path)
+    os.replace(temp_path, meta_path)
+    return df
+
+def read_flows_by_factor(path, sheet_name='Flujos', factor='FACTOR AJ',
+                         required='TIPO CARTERA'):
+    """Streams a sheet of monthly flows and sums them by factor while 
+    reading, so that the wide sheet is never materialized as a whole.
+    The month columns are the ones from the earliest date header on.
+    Rows without required or factor values are skipped, and blank or 
+    non numeric flows count as zero. Formats that openpyxl can't open
+    (see OPENPYXL_EXTENSIONS) are read whole with pandas.read_excel and
+    aggregated in the same way.
+    
+    Inputs:
+    -------
+    path: str
+        Path of the workbook.
+    sheet_name: str (default = 'Flujos')
+        Sheet with the flows.
+    factor: str (default = 'FACTOR AJ')
+        Column used to aggregate the flows.
+    required: str (default = 'TIPO CARTERA')
+        Column that must have a value for the row to be used.
+    
+    Outputs:
+    --------
+    flows: pandas DataFrame
+        Float64 flows with the factors as index and the month headers
+        (as read) as columns.
+    """
+    if os.path.splitext(path)[1].lower() not in OPENPYXL_EXTENSIONS:
+        sheet = pd.read_excel(path, sheet_name=sheet_name)
+        header = list(sheet.columns)
+        start = header.index(min(h for h in header if is_date(h)))
+        sheet = sheet.dropna(subset=[required, factor])
+        flows = sheet.iloc[:, start:].apply(pd.to_numeric, errors='coerce')\
+            .fillna(0).astype(np.float64)
+        flows.index = pd.Index(sheet[factor], name=factor)
+        return flows.groupby(level=0).sum()
+
+    import openpyxl
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb[sheet_name].iter_rows(values_only=True)
+        header = list(next(rows))
+        while header and header[-1] is None:
+            header.pop()
+        factor_index = header.index(factor)
+        required_index = header.index(required)
+        date_headers = [h for h in header if is_date(h)]
+        start = header.index(min(date_headers))
+        months = header[start:]
+        n = len(months)
+        sums = dict()
+        for row in rows:
+            if len(row) <= max(factor_index, required_index) or \
+                row[required_index] is None or row[factor_index] is None:
+                continue
+            values = row[start:start+n]
+            try:
+                flows = np.array(values, dtype=np.float64)
+            except (TypeError, ValueError):
+                flows = pd.to_numeric(pd.Series(values, dtype=object),
+                                      errors='coerce').to_numpy(np.float64)
+            acc = sums.get(row[factor_index])
+            if isinstance(acc, type(None)):
+                acc = sums[row[factor_index]] = np.zeros(n)
+            acc[:len(flows)] += np.nan_to_num(flows)
+    finally:
+        wb.close()
+    factors = sorted(sums)
+    return pd.DataFrame(np.array([sums[f] for f in factors]).reshape(-1, n),
+                        index=pd.Index(factors, name=factor), columns=months)
+
 def return_match(string, list_strings):
     """Returns the string in a list that matches the string searched.
     
@@ -304,6 +1218,55 @@ def days_to_reference(x):
     elif x<=3600: return '10Y'
     elif x>3600: return '+10Y'
 
+def assign_buckets(x, rule='dias'):
+    """Assigns the time bucket of a whole column at once, with the same
+    rules as days_to_reference, reprecio_vencimiento, reprecio_mensual,
+    reprecio_trimestral and reprecio_semestral.
+    
+    Inputs:
+    -------
+    x: pandas Series/array
+        Days (rule 'dias') or months (other rules) of each flow.
+    rule: str (default = 'dias')
+        'dias', 'vencimiento', 'mensual', 'trimestral' or 'semestral'.
+    
+    Outputs:
+    --------
+    buckets: pandas Series/Categorical
+        Ordered categorical with BUCKETS as categories, stored as small
+        integer codes. Missing values stay missing. A Series keeps the
+        index of x.
+    """
+    values = np.asarray(x, dtype=float)
+    missing = np.isnan(values)
+    one_month = BUCKETS.index('1M')
+    if rule == 'dias':
+        codes = np.searchsorted(DAY_EDGES, values, side='left')
+    elif rule == 'vencimiento':
+        codes = one_month+np.searchsorted(MONTH_EDGES, values, side='left')
+    elif rule == 'mensual':
+        modulo = np.mod(values, 12)
+        modulo[modulo==0] = 12
+        codes = one_month+np.searchsorted(MONTH_EDGES[:4], modulo, 
+                                          side='left')
+    elif rule == 'trimestral':
+        codes = np.where(np.mod(values-1, 3)==0, one_month, one_month+1)
+    elif rule == 'semestral':
+        modulo = np.mod(values, 6)
+        codes = np.select(
+            [modulo==1, (modulo!=0)&(modulo<=3)],
+            [one_month, one_month+1],
+            one_month+2
+        )
+    else:
+        raise ValueError(f'Unknown bucket rule: {rule}')
+    codes = np.where(missing, -1, codes).astype(np.int8)
+    buckets = pd.Categorical.from_codes(codes, categories=BUCKETS, 
+                                        ordered=True)
+    if isinstance(x, pd.Series):
+        return pd.Series(buckets, index=x.index, name=x.name)
+    return buckets
+
 def days_to_reprice(x, reference):
     if reference=='1M':
         m = x%30
@@ -318,6 +1281,40 @@ def days_to_reprice(x, reference):
         if m==0: return 180
         else: return m
 
+def vec_days_to_reprice(days, references, periods=None):
+    """Computes the days to the next repricing of every flow at once,
+    with the same rule as days_to_reprice, taking the repricing period
+    of each flow from its reference rate.
+    
+    Inputs:
+    -------
+    days: pandas Series/array
+        Days from the reference date to the payment of each flow.
+    references: pandas Series/array
+        Reference rate of each flow ('LIBOR3M', 'Term SOFR 3M', 
+        'IBR1M', ...). Case, spaces, '-' and '_' are ignored, so LIBOR
+        and SOFR flows can be mixed while the book migrates.
+    periods: dict (default = None)
+        Repricing period in days by normalized reference. If None,
+        REPRICE_PERIODS is used.
+    
+    Outputs:
+    --------
+    days_to_reprice: pandas Series/array
+        Days to the next repricing. Flows with an unknown reference are
+        NaN.
+    """
+    if isinstance(periods, type(None)):
+        periods = REPRICE_PERIODS
+    normalized = pd.Series(np.asarray(references, dtype=object)).astype(str)\
+        .str.upper().str.replace(r'[\s_\-]', '', regex=True)
+    period = normalized.map(periods).to_numpy(dtype=float)
+    remainder = np.mod(np.asarray(days, dtype=float), period)
+    days_to_reprice = np.where(remainder==0, period, remainder)
+    if isinstance(days, pd.Series):
+        return pd.Series(days_to_reprice, index=days.index)
+    return days_to_reprice
+
 def sort_colnames(col_names,buckets):
     sorted_names = []
     for b in buckets:
@@ -335,6 +1332,37 @@ def from_float_to_date(x):
         return date
     else: return x
 
+def excel_serial_to_datetime(x):
+    """Converts a column that mixes Excel serial numbers (1900 date 
+    system) and dates to datetime64 in a single vectorized operation.
+    Int and float serials are taken to the day, counted from 1899-12-30.
+    Serials before March 1st, 1900 (ambiguous because of Excel's 
+    1900-02-29), after pd.Timestamp.max (2262-04-11) and values that are
+    neither numbers nor dates are converted to NaT.
+    
+    Inputs:
+    -------
+    x: pandas Series, numpy array or list
+        Serial numbers and/or dates.
+    
+    Outputs:
+    --------
+    dates: pandas Series
+        datetime64 dates, with the index of x if it is a Series.
+    """
+    x = x if isinstance(x, pd.Series) else pd.Series(x)
+    if pd.api.types.is_datetime64_any_dtype(x):
+        return x
+    serials = pd.to_numeric(x.astype(object), errors='coerce')
+    is_serial = serials.notna().to_numpy()
+    max_serial = (pd.Timestamp.max.date()-date(1899, 12, 30)).days
+    valid = is_serial & (serials>=61).to_numpy() & \
+        (serials<max_serial+1).to_numpy()
+    dates = pd.to_datetime(x.where(~is_serial), errors='coerce')
+    dates[valid] = pd.to_datetime(np.floor(serials[valid]), unit='D',
+                                  origin='1899-12-30')
+    return dates
+
 def define_buckets(x, buckets):
     b = list()
     for i in x:
@@ -479,7 +1507,8 @@ class BankingBook(object):
         pv_gap = bb['gap']/(1+yc)**bb['t_k']
         return pv_gap
 
-    def variation_eve(self, r_shock=200, short_shock=300, long_shock=150):
+    def variation_eve(self, r_shock=200, short_shock=300, long_shock=150,
+                      currency=None):
         """Computes the variation of the Economic Value of Equity for
         the 6 shocks prescribed by the BIS in the banking book.
         
@@ -491,6 +1520,9 @@ class BankingBook(object):
             Value of the short-side shock in basis points.
         long_shock: numerical value (default = 150)
             Value of the long-side shock in basis points.
+        currency: str (default = None)
+            If given, the shocks and the post-shock floor of the currency
+            in SHOCK_REGISTRY are used instead of the shock sizes.
         
         Outputs:
         --------
@@ -498,49 +1530,79 @@ class BankingBook(object):
             Dataframe with the variation of the EVE for each shock as
             columns.
         """
-        # Compute present value of banking book without shocks:
-        pv_gap_original = self.bb_al['gap']/(1+self.yield_curve)**\
-                            self.bb_al['t_k']
-        
-        # Compute the present values of the gaps with the shocks:
-        parallel_up = self.parallel_shock(
-            r_shock = r_shock,
-            direction = 1
-        )
-        parallel_down = self.parallel_shock(
+        delta_buckets = self.delta_eve_buckets(
             r_shock = r_shock,
-            direction = -1
-        )
-        short_up = self.short_shock(
-            r_shock = short_shock,
-            direction = 1
-        )
-        short_down = self.short_shock(
-            r_shock = short_shock,
-            direction = -1
-        )
-        steepner = self.rotation_shock(
-            short_shock = short_shock,
-            long_shock= long_shock,
-            direction = 'steepner'
-        )
-        flattener = self.rotation_shock(
             short_shock = short_shock,
             long_shock = long_shock,
-            direction = 'flattener'
+            currency = currency
         )
-
-        # Create DataFrame with results:
-        delta_eve = pd.DataFrame()
-        delta_eve['parallel_up'] = parallel_up
-        delta_eve['parallel_down'] = parallel_down
-        delta_eve['short_up '] = short_up
-        delta_eve['short_down'] = short_down
-        delta_eve['steepner'] = steepner
-        delta_eve['flattener'] = flattener
-        delta_eve = delta_eve.sum()-pv_gap_original.sum()
+        delta_eve = delta_buckets.sum()
         return delta_eve.to_frame().rename(columns={0:'Delta_EVE'})
 
+    def delta_eve_buckets(self, r_shock=200, short_shock=300, long_shock=150,
+                          currency=None):
+        """Computes the variation of the present value of the gap of
+        each time bucket for the 6 shocks prescribed by the BIS, with
+        all the shocked curves discounted at once.
+        
+        Inputs:
+        -------
+        r_shock: numerical value (default = 200)
+            Value of the parallel shock in basis points.
+        short_shock: numerical value (default = 300)
+            Value of the short-side shock in basis points.
+        long_shock: numerical value (default = 150)
+            Value of the long-side shock in basis points.
+        currency: str (default = None)
+            If given, the shocks and the post-shock floor of the currency
+            in SHOCK_REGISTRY are used instead of the shock sizes.
+        
+        Outputs:
+        --------
+        delta_buckets: pandas DataFrame
+            Dataframe with the time buckets as rows and the shocks as
+            columns. Its column sums are the variations of the EVE.
+        """
+        shifts, floor = SHOCK_REGISTRY.scenario(currency, r_shock, 
+                                                short_shock, long_shock)
+        delta_buckets, _ = eve_engine(
+            gap = self.bb_al['gap'].to_numpy(dtype=float),
+            t_k = self.bb_al['t_k'].to_numpy(dtype=float),
+            yield_curve = self.yield_curve,
+            shifts = shifts,
+            floor = floor
+        )
+        return pd.DataFrame(
+            delta_buckets.T,
+            index = self.bb_al.index,
+            columns = SCENARIOS
+        )
+
+    def key_rate_risk(self):
+        """Computes the key rate sensitivities of the banking book for
+        each time bucket, in closed form from the discounting of the
+        gaps.
+        
+        Outputs:
+        --------
+        key_rates: pandas DataFrame
+            For each time bucket: present value of the gap, DV01 (change
+            of value for a 1 bp increase of the node), key rate duration
+            (minus the derivative divided by the EVE) and convexity
+            (second derivative).
+        """
+        pv_gap, delta, gamma = key_rate_sensitivities(
+            gap = self.bb_al['gap'].to_numpy(dtype=float),
+            t_k = self.bb_al['t_k'].to_numpy(dtype=float),
+            yield_curve = self.yield_curve
+        )
+        return pd.DataFrame({
+            'pv_gap': pv_gap,
+            'dv01': delta*1e-4,
+            'key_rate_duration': -delta/pv_gap.sum(),
+            'convexity': gamma
+        }, index=self.bb_al.index)
+
     def calculate_nii(self, pv=True, T=1, T_rate=None, yield_curve=None):
         """Calculates the Net Interest Income for the Banking Book
         stored in the instance of the object.
@@ -570,8 +1632,7 @@ class BankingBook(object):
         
         # Interpolate T_rate if not given:
         if isinstance(T_rate,type(None)):
-            function = interp1d(T_K, yield_curve, kind='cubic')
-            T_rate = function(T)
+            T_rate = curve_interpolator(yield_curve)(T)
             print("Interest rate of the horizon of evaluation wasn't given.\
                  Cubic interpolation used.")
         
@@ -584,6 +1645,110 @@ class BankingBook(object):
             nii_sequence = nii_sequence*np.exp(-iT_rate*T)
         return nii_sequence
 
+    def nii_term_structure(self, T, pv=True, T_rate=None, yield_curve=None):
+        """Calculates the Net Interest Income of each time bucket for
+        several horizons in one call.
+        
+        Inputs:
+        -------
+        T: array
+            Time horizons in which the NII will be computed, in years.
+        pv: Boolean (deafult = True)
+            Determines whether we bring the values present value or not.
+        T_rate: array (default = None).
+            Interest rate at each horizon. If None, it is obtained by
+            cubic interpolation of the yield curve.
+        yield_curve: array (default = None).
+            Interest rates of the medium points of the 19 time buckets.
+            If None, the yield curve of the banking book is used.
+        
+        Outputs:
+        --------
+        nii_matrix: pandas DataFrame
+            NII with the horizons as rows and the time buckets as 
+            columns. Buckets beyond each horizon are zero.
+        """
+        T = np.atleast_1d(np.asarray(T, dtype=float))
+        if isinstance(yield_curve, type(None)):
+            yield_curve = self.yield_curve
+        if isinstance(T_rate, type(None)):
+            T_rate = curve_interpolator(yield_curve)(T)
+        nii_matrix = nii_engine(
+            gap = self.bb_al['gap'].to_numpy(dtype=float),
+            t_k = self.bb_al['t_k'].to_numpy(dtype=float),
+            curves = yield_curve,
+            T = T[:,None],
+            T_rate = np.broadcast_to(np.asarray(T_rate, dtype=float),
+                                     T.shape),
+            pv = pv
+        )
+        return pd.DataFrame(nii_matrix, index=pd.Index(T, name='T'),
+                            columns=self.bb_al.index)
+
+    def delta_nii_buckets(self, r_shock=200, short_shock=300, long_shock=150,
+                          currency=None, custom_curves=None, pv=True, T=1,
+                          T_rate=None, constant_balance=False):
+        """Computes the variation of the Net Interest Income of each 
+        time bucket for the 6 shocks prescribed by the BIS, and for any
+        custom curve, with all the curves evaluated at once.
+        
+        Inputs:
+        -------
+        r_shock, short_shock, long_shock: numerical values
+            Shock sizes in basis points, as in variation_eve.
+        currency: str (default = None)
+            If given, the shocks and the floor of the currency in 
+            SHOCK_REGISTRY are used instead of the shock sizes.
+        custom_curves: dict (default = None)
+            Additional shocked yield curves by scenario name.
+        pv: boolean (default = True)
+            Determines whether to compute the NII variation in present
+            value or not.
+        T: numercial value (default = 1)
+            Time horizon of the NII, in years.
+        T_rate: numerical value (default = None)
+            Interest rate at the time horizon T. If None, it is 
+            interpolated from the yield curve. The rate of each scenario
+            moves by the interpolated shift of its curve.
+        constant_balance: boolean (default = False)
+            If True, the repricing gaps are renewed at the rate of their
+            own bucket until the horizon (constant balance sheet).
+        
+        Outputs:
+        --------
+        delta_nii: pandas DataFrame
+            Dataframe with the time buckets as rows and the scenarios as
+            columns. Its column sums are the variations of the NII.
+        """
+        shifts, floor = SHOCK_REGISTRY.scenario(currency, r_shock, 
+                                                short_shock, long_shock)
+        base = np.asarray(self.yield_curve, dtype=float)
+        scenarios = list(SCENARIOS)
+        curves = [base[None,:], shocked_curves(base, shifts, floor)]
+        if not isinstance(custom_curves, type(None)):
+            scenarios += list(custom_curves.keys())
+            curves.append(np.vstack([np.asarray(c, dtype=float) for c in 
+                                     custom_curves.values()]))
+        curves = np.vstack(curves)
+        weights_T = interpolation_weights(T)
+        if isinstance(T_rate, type(None)):
+            T_rate = base@weights_T
+        rates = T_rate+(curves-base)@weights_T
+        nii = nii_engine(
+            gap = self.bb_al['gap'].to_numpy(dtype=float),
+            t_k = self.bb_al['t_k'].to_numpy(dtype=float),
+            curves = curves,
+            T = T,
+            T_rate = rates,
+            pv = pv,
+            constant_balance = constant_balance
+        )
+        return pd.DataFrame(
+            (nii[1:]-nii[0]).T,
+            index = self.bb_al.index,
+            columns = scenarios
+        )
+
     def variation_nii(self, r_shock=200, pv=True, T=1, T_rate=None):
         """Calculates the variation on the Net Interest Income of a 
         parallel interest rate shock.
@@ -608,8 +1773,7 @@ class BankingBook(object):
         """
         # Interpolate T_rate if not given:
         if isinstance(T_rate,type(None)):
-            function = interp1d(T_K, self.yield_curve, kind='cubic')
-            T_rate = function(T)
+            T_rate = curve_interpolator(self.yield_curve)(T)
             print("Interest rate of the horizon of evaluation wasn't given.\
                  Cubic interpolation used.")
         delta_nii = pd.DataFrame()
@@ -637,11 +1801,772 @@ class BankingBook(object):
         return delta_nii
             
 
+class BankingBookBatch(object):
+    """This class stacks the gaps and yield curves of many banking books
+    (entities, currencies) into arrays, and computes the variation of
+    their Economic Value of Equity and Net Interest Income for the six 
+    BIS shocks in one vectorized pass."""
+
+    def __init__(self, books, t_k=None, currencies=None):
+        """
+        Inputs:
+        -------
+        books: dict
+            Banking books by portfolio name. The values can be 
+            BankingBook objects or (bb_al, yield_curve) tuples, with
+            bb_al as described in BankingBook. Tuple keys, such as 
+            (entity, currency), become levels of the results index.
+        t_k: array (default = None)
+            Maturities of the time buckets, shared by all the books. If
+            None, the 't_k' column of the books is used.
+        currencies: list (default = None)
+            Currency of each book, in the order of books. If given, the
+            shocks are taken from SHOCK_REGISTRY when no shock sizes are
+            passed to the methods.
+        """
+        self.keys = list(books.keys())
+        self.currencies = currencies
+        gaps, curves, maturities = [], [], []
+        for key in self.keys:
+            book = books[key]
+            if not isinstance(book, BankingBook):
+                book = BankingBook(book[0].copy(), book[1])
+            gaps.append(book.bb_al['gap'].to_numpy(dtype=float))
+            curves.append(np.asarray(book.yield_curve, dtype=float))
+            if isinstance(t_k, type(None)):
+                maturities.append(book.bb_al['t_k'].to_numpy(dtype=float))
+        if isinstance(t_k, type(None)):
+            t_k = maturities[0]
+            if not all(np.array_equal(t_k, m) for m in maturities):
+                raise ValueError('All the banking books must share the same'
+                                 ' time buckets (t_k).')
+        self.t_k = np.asarray(t_k, dtype=float)
+        self.gaps = np.vstack(gaps)
+        self.yield_curves = np.vstack(curves)
+        if isinstance(self.keys[0], tuple):
+            self.index = pd.MultiIndex.from_tuples(self.keys)
+        else:
+            self.index = pd.Index(self.keys, name='portfolio')
+
+    def _scenarios(self, r_shock, short_shock, long_shock):
+        """Returns the shifts and the floor used by the methods. Shock
+        sizes left as None come from the registry (if currencies were
+        given) or from the BIS defaults."""
+        if all(isinstance(shock, type(None)) for shock in 
+               [r_shock, short_shock, long_shock]) and \
+                not isinstance(self.currencies, type(None)):
+            return (SHOCK_REGISTRY.stacked_shifts(self.currencies, self.t_k),
+                    SHOCK_REGISTRY.floor_at(self.t_k))
+        defaults = [200, 300, 150]
+        shocks = [d if isinstance(shock, type(None)) else shock for shock, d
+                  in zip([r_shock, short_shock, long_shock], defaults)]
+        return scenario_shifts(*shocks, self.t_k), None
+
+    def _cube(self, values, name):
+        """Returns a (portfolios x scenarios) array as a tidy series."""
+        cube = pd.DataFrame(values, index=self.index, columns=SCENARIOS)
+        cube.columns.name = 'scenario'
+        return cube.stack().rename(name)
+
+    def variation_eve(self, r_shock=None, short_shock=None, long_shock=None):
+        """Computes the variation of the Economic Value of Equity of
+        every portfolio for the 6 shocks prescribed by the BIS.
+        
+        Inputs:
+        -------
+        r_shock: numerical value/array (default = None)
+            Value of the parallel shock in basis points. An array gives
+            one value per portfolio. If the three shock sizes are None,
+            the shocks of the currencies are used; without currencies
+            the defaults are 200, 300 and 150.
+        short_shock: numerical value/array (default = None)
+            Value of the short-side shock in basis points.
+        long_shock: numerical value/array (default = None)
+            Value of the long-side shock in basis points.
+        
+        Outputs:
+        --------
+        delta_eve: pandas Series
+            Variation of the EVE indexed by portfolio and scenario.
+        """
+        shifts, floor = self._scenarios(r_shock, short_shock, long_shock)
+        _, delta_eve = eve_engine(
+            gap = self.gaps,
+            t_k = self.t_k,
+            yield_curve = self.yield_curves,
+            shifts = shifts,
+            floor = floor
+        )
+        return self._cube(delta_eve, 'Delta_EVE')
+
+    def variation_nii(self, r_shock=None, short_shock=None, long_shock=None,
+                      pv=True, T=1, T_rate=None):
+        """Computes the variation of the Net Interest Income of every 
+        portfolio for the 6 shocks prescribed by the BIS. The rate at the
+        horizon moves by the interpolated shift of each shock, which for
+        the parallel shocks is the same as BankingBook.variation_nii.
+        
+        Inputs:
+        -------
+        r_shock, short_shock, long_shock: numerical value/array
+            Shock sizes in basis points, as in variation_eve.
+        pv: boolean (default = True)
+            Determines whether to compute the NII variation in present
+            value or not.
+        T: numercial value (default = 1)
+            Time horizon considered for the computation of the variation
+            of the NII, in years.
+        T_rate: numerical value/array (default = None)
+            Interest rate at the time horizon T of each portfolio. If 
+            None, it is interpolated from each yield curve.
+        
+        Outputs:
+        --------
+        delta_nii: pandas Series
+            Variation of the NII indexed by portfolio and scenario.
+        """
+        shifts, floor = self._scenarios(r_shock, short_shock, long_shock)
+        shocked = shocked_curves(self.yield_curves, shifts, floor)
+        shifts = shocked-self.yield_curves[:,None,:]
+        if isinstance(T_rate, type(None)):
+            T_rate = interp1d(self.t_k, self.yield_curves, kind='cubic',
+                              axis=-1)(T)
+        T_rate = np.broadcast_to(np.asarray(T_rate, dtype=float), 
+                                 (len(self.keys),))
+        shifts_T = interp1d(self.t_k, shifts, kind='cubic', axis=-1)(T)
+        curves = np.concatenate([self.yield_curves[:,None,:], shocked], axis=1)
+        rates = np.concatenate([
+            T_rate[:,None],
+            T_rate[:,None]+shifts_T
+        ], axis=1)
+        nii = nii_engine(
+            gap = self.gaps[:,None,:],
+            t_k = self.t_k,
+            curves = curves,
+            T = T,
+            T_rate = rates,
+            pv = pv
+        ).sum(axis=-1)
+        return self._cube(nii[:,1:]-nii[:,:1], 'Delta_NII')
+
+    def key_rate_risk(self):
+        """Computes the key rate sensitivities of every portfolio for
+        each time bucket in one vectorized call.
+        
+        Outputs:
+        --------
+        key_rates: pandas DataFrame
+            Tidy table indexed by portfolio and time bucket maturity,
+            with the present value of the gap, the DV01, the key rate
+            duration (minus the derivative divided by the EVE of the
+            portfolio) and the convexity. approx_delta_eve gives the 
+            variation of the EVE for any shift from the unstacked 
+            dv01/convexity.
+        """
+        pv_gap, delta, gamma = key_rate_sensitivities(
+            self.gaps, self.t_k, self.yield_curves)
+        duration = -delta/pv_gap.sum(axis=-1, keepdims=True)
+        columns = pd.Index(self.t_k, name='t_k')
+        return pd.concat({
+            'pv_gap': pd.DataFrame(pv_gap, self.index, columns).stack(),
+            'dv01': pd.DataFrame(delta*1e-4, self.index, columns).stack(),
+            'key_rate_duration': pd.DataFrame(duration, self.index, 
+                                              columns).stack(),
+            'convexity': pd.DataFrame(gamma, self.index, columns).stack()
+        }, axis=1)
+
+    def evaluate(self, r_shock=None, short_shock=None, long_shock=None,
+                 pv=True, T=1, T_rate=None):
+        """Computes the variation of the EVE and the NII of every
+        portfolio for the 6 shocks prescribed by the BIS.
+        
+        Outputs:
+        --------
+        results: pandas DataFrame
+            Tidy table indexed by portfolio and scenario, with the
+            columns Delta_EVE and Delta_NII.
+        """
+        return pd.concat([
+            self.variation_eve(r_shock, short_shock, long_shock),
+            self.variation_nii(r_shock, short_shock, long_shock, pv, T,
+                               T_rate)
+        ], axis=1)
+
+
+class ShockRegistry(object):
+    """This class holds the BIS (SRP31) shock sizes of each currency and
+    the post-shock floor. The six-scenario shift matrix of a currency is
+    computed once for each grid of maturities, the first time it is 
+    used, and reused in every valuation."""
+
+    def __init__(self, shocks=None, t_k=None, floor_start=-150, floor_step=3):
+        """
+        Inputs:
+        -------
+        shocks: dict (default = None)
+            Shock sizes (parallel, short, long) in basis points by 
+            currency. If None, SRP31_SHOCKS is used.
+        t_k: array (default = None)
+            Maturities of the shift matrices. If None, T_K is used.
+        floor_start: numerical value (default = -150)
+            Post-shock floor at the immediate maturity, in basis points.
+            If None, no floor is applied.
+        floor_step: numerical value (default = 3)
+            Yearly increase of the floor in basis points, until it 
+            reaches 0%.
+        """
+        if isinstance(shocks, type(None)):
+            shocks = SRP31_SHOCKS
+        if isinstance(t_k, type(None)):
+            t_k = T_K
+        self.shocks = dict(shocks)
+        self.t_k = np.asarray(t_k, dtype=float)
+        self.floor_start = floor_start
+        self.floor_step = floor_step
+        self.floor = self.floor_at(self.t_k)
+        self._shifts = {}
+
+    def _grid(self, t_k):
+        """Returns the maturities to use and the key of their grid in the
+        cache of shift matrices (None for the grid of the registry)."""
+        if isinstance(t_k, type(None)):
+            return self.t_k, None
+        t_k = np.asarray(t_k, dtype=float)
+        if np.array_equal(t_k, self.t_k):
+            return self.t_k, None
+        return t_k, tuple(t_k)
+
+    def floor_at(self, t_k=None):
+        """Returns the post-shock floor at some maturities (the ones of
+        the registry if t_k is None), or None if there is no floor."""
+        if isinstance(self.floor_start, type(None)):
+            return None
+        t_k, _ = self._grid(t_k)
+        return np.minimum((self.floor_start+self.floor_step*t_k)*1e-4, 0)
+
+    def register(self, currency, r_shock, short_shock, long_shock):
+        """Adds or replaces the shock sizes (in basis points) of a 
+        currency."""
+        self.shocks[currency] = (r_shock, short_shock, long_shock)
+        for key in [key for key in self._shifts if key[0]==currency]:
+            del self._shifts[key]
+
+    def shifts(self, currency, t_k=None):
+        """Returns the (6 x len(t_k)) shift matrix of a currency, in the
+        order of SCENARIOS, at the maturities t_k (the ones of the 
+        registry if None). The matrix is read-only and shared."""
+        t_k, grid = self._grid(t_k)
+        if (currency, grid) not in self._shifts:
+            if currency not in self.shocks:
+                raise KeyError(f'No shocks registered for {currency}.')
+            shifts = scenario_shifts(*self.shocks[currency], t_k)
+            shifts.setflags(write=False)
+            self._shifts[(currency, grid)] = shifts
+        return self._shifts[(currency, grid)]
+
+    def scenario(self, currency=None, r_shock=200, short_shock=300, 
+                 long_shock=150, t_k=None):
+        """Returns the shifts (6 x len(t_k)) and the post-shock floor of a
+        valuation: those of the currency if one is given, or the shifts 
+        of the shock sizes, without floor, otherwise. Both are built at
+        the maturities t_k (the ones of the registry if None)."""
+        if isinstance(currency, type(None)):
+            return scenario_shifts(r_shock, short_shock, long_shock, t_k), None
+        return self.shifts(currency, t_k), self.floor_at(t_k)
+
+    def stacked_shifts(self, currencies, t_k=None):
+        """Returns the shift matrices of several currencies as an array
+        (currencies x 6 x len(t_k))."""
+        return np.stack([self.shifts(currency, t_k) for currency in 
+                         currencies])
+
+    def shocked_curves(self, currency, yield_curve):
+        """Returns the six shocked curves (6 x len(t_k)) of a currency,
+        with the post-shock floor applied."""
+        return shocked_curves(yield_curve, self.shifts(currency), self.floor)
+
+SHOCK_REGISTRY = ShockRegistry()
+
+
+class IncrementalEVE(object):
+    """This class keeps the discount factors of the base curve and the
+    six shocked curves of a banking book, so that the EVE and its
+    variations are updated in constant time when a position of one time
+    bucket is added, removed or amended."""
+
+    def __init__(self, bb, r_shock=200, short_shock=300, long_shock=150,
+                 currency=None):
+        """
+        Inputs:
+        -------
+        bb: BankingBook
+            Banking book with the initial positions.
+        r_shock, short_shock, long_shock: numerical values
+            Shock sizes in basis points, as in BankingBook.variation_eve.
+        currency: str (default = None)
+            If given, the shocks and the floor of the currency in
+            SHOCK_REGISTRY are used instead of the shock sizes.
+        """
+        shifts, floor = SHOCK_REGISTRY.scenario(currency, r_shock, 
+                                                short_shock, long_shock)
+        self.index = bb.bb_al.index
+        self._positions = {label: i for i, label in enumerate(self.index)}
+        self.t_k = bb.bb_al['t_k'].to_numpy(dtype=float)
+        curve = np.asarray(bb.yield_curve, dtype=float)
+        curves = np.vstack([curve, shocked_curves(curve, shifts, floor)])
+        self.discount_factors = (1+curves)**-self.t_k
+        self.assets = bb.bb_al['assets'].to_numpy(dtype=float).copy()
+        self.liabilities = bb.bb_al['liabilities'].to_numpy(dtype=float)\
+            .copy()
+        self.refresh()
+
+    def refresh(self):
+        """Recomputes the present values from all the positions. It 
+        removes the rounding errors accumulated by the updates."""
+        self.gap = self.assets-self.liabilities
+        self.pv = self.discount_factors@self.gap
+
+    def _update(self, bucket, amount, side):
+        if side == 'assets':
+            self.assets[bucket] += amount
+        elif side == 'liabilities':
+            self.liabilities[bucket] += amount
+            amount = -amount
+        else:
+            raise ValueError("side must be 'assets' or 'liabilities'.")
+        self.gap[bucket] += amount
+        self.pv += self.discount_factors[:,bucket]*amount
+
+    def add(self, bucket, amount, side='assets'):
+        """Adds a position to a time bucket.
+        
+        Inputs:
+        -------
+        bucket: index label
+            Label of the time bucket in bb_al.
+        amount: numerical value
+            Nominal of the position.
+        side: str (default = 'assets')
+            'assets' or 'liabilities'.
+        """
+        self._update(self._positions[bucket], amount, side)
+
+    def remove(self, bucket, amount, side='assets'):
+        """Removes a position from a time bucket (for example a prepaid
+        loan or a matured CDT)."""
+        self._update(self._positions[bucket], -amount, side)
+
+    def amend(self, bucket, old_amount, new_amount, side='assets'):
+        """Replaces the nominal of a position of a time bucket."""
+        self._update(self._positions[bucket], new_amount-old_amount, side)
+
+    @property
+    def eve(self):
+        """Economic Value of Equity with the base curve."""
+        return self.pv[0]
+
+    @property
+    def delta_eve(self):
+        """Variation of the EVE for each shock, as a pandas Series."""
+        return pd.Series(self.pv[1:]-self.pv[0], index=SCENARIOS,
+                         name='Delta_EVE')
+
+    def to_frame(self):
+        """Returns the current positions as a bb_al DataFrame."""
+        return pd.DataFrame({
+            't_k': self.t_k,
+            'assets': self.assets,
+            'liabilities': self.liabilities,
+            'gap': self.gap
+        }, index=self.index)
+
+
+class NelsonSiegelMonteCarlo(object):
+    """This class simulates the distribution of the variation of the
+    Economic Value of Equity and the Net Interest Income of a banking
+    book, drawing the Nelson-Siegel factors of the yield curve from a
+    multivariate normal distribution (or a custom sampler)."""
+
+    def __init__(self, bb, mean=(0.0175, 0.003, 0.02), cov=None, 
+                 lmbda=0.0609, sampler=None, seed=None, chunk_size=100000):
+        """
+        Inputs:
+        -------
+        bb: BankingBook
+            Banking book revalued with each simulated curve. Its 
+            yield_curve is the base scenario.
+        mean: array (default = (0.0175, 0.003, 0.02))
+            Mean of (beta_1, beta_2, beta_3), or of (beta_1, beta_2,
+            beta_3, lmbda) if lambda is also simulated.
+        cov: array (default = None)
+            Covariance matrix of the factors, of the same size as mean.
+            Required when no sampler is given.
+        lmbda: float (default = 0.0609)
+            Decay parameter used when it is not simulated.
+        sampler: callable (default = None)
+            Function sampler(rng, size) that returns an array (size x 3)
+            or (size x 4) of factors. It replaces mean and cov.
+        seed: int (default = None)
+            Seed of the random generator. The same seed gives the same
+            draws for any chunk_size.
+        chunk_size: int (default = 100000)
+            Number of curves built at once. It bounds the memory used.
+        """
+        if isinstance(sampler, type(None)) and isinstance(cov, type(None)):
+            raise ValueError('A covariance matrix or a sampler is needed.')
+        self.bb = bb
+        self.mean = np.asarray(mean, dtype=float)
+        self.lmbda = lmbda
+        self.sampler = sampler
+        self.seed = seed
+        self.chunk_size = int(chunk_size)
+        if not isinstance(cov, type(None)):
+            self.chol = np.linalg.cholesky(np.asarray(cov, dtype=float))
+        self.t_k = bb.bb_al['t_k'].to_numpy(dtype=float)
+        self.gap = bb.bb_al['gap'].to_numpy(dtype=float)
+        self.draws = None
+
+    def _sample(self, rng, size):
+        """Draws a chunk of factor vectors."""
+        if not isinstance(self.sampler, type(None)):
+            return np.asarray(self.sampler(rng, size), dtype=float)
+        z = rng.standard_normal((size, len(self.mean)))
+        return self.mean+z@self.chol.T
+
+    def run(self, n_sims=1000000, T=1, pv=True):
+        """Simulates the curves in chunks and revalues the banking book 
+        for each one.
+        
+        Inputs:
+        -------
+        n_sims: int (default = 1000000)
+            Number of simulated curves.
+        T: numerical value (default = 1)
+            Horizon of the NII, in years.
+        pv: Boolean (default = True)
+            Determines whether the NII is brought to present value.
+        
+        Outputs:
+        --------
+        draws: pandas DataFrame
+            Variation of the EVE and the NII of each simulated curve.
+        """
+        rng = np.random.default_rng(self.seed)
+        weights_T = interpolation_weights(T, self.t_k)
+        base_curve = np.asarray(self.bb.yield_curve, dtype=float)
+        base_eve = np.sum(self.gap*(1+base_curve)**-self.t_k)
+        base_nii = nii_engine(self.gap, self.t_k, base_curve, T,
+                              base_curve@weights_T, pv).sum()
+        delta_eve = np.empty(n_sims)
+        delta_nii = np.empty(n_sims)
+        loadings = nelson_siegel_loadings(self.lmbda, self.t_k)
+        for start in range(0, n_sims, self.chunk_size):
+            stop = min(start+self.chunk_size, n_sims)
+            factors = self._sample(rng, stop-start)
+            if factors.shape[1] == 4:
+                curves = np.einsum(
+                    'snf,sf->sn',
+                    nelson_siegel_loadings(factors[:,3], self.t_k),
+                    factors[:,:3]
+                )
+            else:
+                curves = factors@loadings.T
+            delta_eve[start:stop] = (self.gap*(1+curves)**-self.t_k)\
+                .sum(axis=1)-base_eve
+            delta_nii[start:stop] = nii_engine(self.gap, self.t_k, curves, T,
+                curves@weights_T, pv).sum(axis=1)-base_nii
+        self.draws = pd.DataFrame({
+            'Delta_EVE': delta_eve,
+            'Delta_NII': delta_nii
+        })
+        return self.draws
+
+    def summary(self, quantiles=(0.01, 0.05, 0.5, 0.95, 0.99), alpha=0.99):
+        """Summarizes the simulated distribution of the variations.
+        
+        Inputs:
+        -------
+        quantiles: list (default = (0.01, 0.05, 0.5, 0.95, 0.99))
+            Quantiles reported.
+        alpha: float (default = 0.99)
+            Confidence level of the expected shortfall, computed as the
+            mean of the variations below the 1-alpha quantile (losses).
+        
+        Outputs:
+        --------
+        summary: pandas DataFrame
+            Mean, quantiles and expected shortfall of the variation of
+            the EVE and the NII.
+        """
+        if isinstance(self.draws, type(None)):
+            raise ValueError('There are no simulations. Call run first.')
+        summary = self.draws.quantile(list(quantiles))
+        summary.index = [f'q_{q:g}' for q in quantiles]
+        tail = self.draws.quantile(1-alpha)
+        shortfall = self.draws[self.draws<=tail].mean()
+        summary.loc['mean'] = self.draws.mean()
+        summary.loc[f'ES_{alpha:g}'] = shortfall
+        return summary
+
+
+def assemble_gap(rows, names):
+    """Stacks the rows of a gap table in a single aligned concatenation
+    over the ['N/M']+BUCKETS columns. Buckets missing in a row are 
+    filled with zeros.
+    
+    Inputs:
+    -------
+    rows: list
+        (label, row) pairs, where label is a tuple and row is a pandas 
+        Series indexed by 'N/M' and/or the buckets.
+    names: list
+        Names of the index levels of the labels.
+    
+    Outputs:
+    --------
+    gap: pandas DataFrame
+        Gap table indexed by the labels.
+    """
+    labels, series = zip(*rows)
+    series = [pd.Series(row.to_numpy(dtype=float), 
+                        index=row.index.astype(object)) for row in series]
+    gap = pd.concat(series, axis=1, ignore_index=True).T\
+        .reindex(columns=['N/M']+BUCKETS).fillna(0)
+    gap.index = pd.MultiIndex.from_tuples(labels, names=names)
+    return gap
+
+def bucket_flows_by_date(flows, ref_dates, reprice=False):
+    """Sums the capital flows by reference rate and bucket for several 
+    reference dates at once. The days of every flow to every reference
+    date are computed as a (dates x flows) matrix and bucketed in a 
+    single vectorized pass.
+    
+    Inputs:
+    -------
+    flows: pandas DataFrame
+        Flows with 'Periodos de Pago', 'Tasa Referencia' and 'Flujos 
+        Capital' columns.
+    ref_dates: list
+        Reference dates.
+    reprice: bool (default = False)
+        If True, the flows are bucketed by days to the next repricing
+        instead of days to payment.
+    
+    Outputs:
+    --------
+    references: pandas Index
+        Sorted reference rates.
+    sums: numpy array
+        (dates x references x BUCKETS) sums of the capital flows.
+    present: numpy array
+        (dates x references) True where a reference has bucketed flows.
+    """
+    pay = excel_serial_to_datetime(flows['Periodos de Pago'])\
+        .to_numpy(dtype='datetime64[D]')
+    dates = pd.to_datetime(ref_dates).to_numpy(dtype='datetime64[D]')
+    days = (pay[None,:]-dates[:,None])/np.timedelta64(1,'D')+1
+    if reprice:
+        references = np.tile(flows['Tasa Referencia'].to_numpy(dtype=object),
+                             len(dates))
+        days = vec_days_to_reprice(days.ravel(), references)\
+            .reshape(days.shape)
+    ref_codes, references = pd.factorize(flows['Tasa Referencia'], sort=True)
+    bucket_codes = np.asarray(assign_buckets(days.ravel()).codes)\
+        .reshape(days.shape).astype(np.int64)
+    cells = (np.arange(len(dates))[:,None]*len(references)+ref_codes[None,:])
+    valid = (bucket_codes>=0) & (ref_codes>=0)[None,:]
+    amounts = np.nan_to_num(flows['Flujos Capital'].to_numpy(dtype=float))
+    amounts = np.broadcast_to(amounts[None,:], days.shape)
+    sums = np.bincount((cells*len(BUCKETS)+bucket_codes)[valid], 
+                       weights=amounts[valid], 
+                       minlength=len(dates)*len(references)*len(BUCKETS))
+    present = np.bincount(cells[valid], 
+                          minlength=len(dates)*len(references)) > 0
+    return (pd.Index(references), 
+            sums.reshape(len(dates), len(references), len(BUCKETS)),
+            present.reshape(len(dates), len(references)))
+
+def iter_sheet_chunks(path, sheet_name, columns, chunk_size=100000):
+    """Streams the rows of a sheet in chunks, keeping only some columns,
+    so that large contract-level files are never loaded as a whole.
+    
+    Inputs:
+    -------
+    path: str
+        Path of the workbook.
+    sheet_name: str
+        Sheet with the flows. The first row has the headers.
+    columns: list
+        Columns kept.
+    chunk_size: int (default = 100000)
+        Number of rows of each chunk.
+    
+    Outputs:
+    --------
+    chunks: generator
+        pandas DataFrames with the kept columns. Formats that openpyxl 
+        can't open (see OPENPYXL_EXTENSIONS) are read with 
+        pandas.read_excel and then split in chunks.
+    """
+    if os.path.splitext(path)[1].lower() not in OPENPYXL_EXTENSIONS:
+        sheet = pd.read_excel(path, sheet_name=sheet_name, usecols=columns)
+        for start in range(0, len(sheet), chunk_size):
+            yield sheet.iloc[start:start+chunk_size][columns]\
+                .reset_index(drop=True)
+        return
+
+    import openpyxl
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb[sheet_name].iter_rows(values_only=True)
+        header = list(next(rows))
+        positions = [header.index(column) for column in columns]
+        chunk = []
+        for row in rows:
+            chunk.append([row[i] if i < len(row) else None 
+                          for i in positions])
+            if len(chunk) == chunk_size:
+                yield pd.DataFrame(chunk, columns=columns)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=columns)
+    finally:
+        wb.close()
+
+class GapAccumulator(object):
+    """This class sums flows by reference rate and bucket one chunk at a
+    time into fixed (references x BUCKETS) arrays, so that the memory 
+    used doesn't depend on the number of flows. Each chunk is summed with
+    pandas' groupby sum, which is compensated (Kahan) in the order of the
+    flows as the groupby/pivot of the whole sheet, and the chunk sums are
+    accumulated with Kahan compensation. A single chunk gives exactly the
+    groupby/pivot table; several chunks give it up to the rounding of 
+    the compensated sums."""
+
+    def __init__(self, index_name='Tasa Referencia', columns_name='Reprecio'):
+        """
+        Inputs:
+        -------
+        index_name: str (default = 'Tasa Referencia')
+            Name of the index of the table.
+        columns_name: str (default = 'Reprecio')
+            Name of the columns of the table.
+        """
+        self.index_name = index_name
+        self.columns_name = columns_name
+        self.references = dict()
+        self.sums = np.zeros((0, len(BUCKETS)))
+        self.compensation = np.zeros((0, len(BUCKETS)))
+        self.counts = np.zeros((0, len(BUCKETS)), dtype=np.int64)
+
+    def add(self, references, buckets, values):
+        """Adds a chunk of flows.
+        
+        Inputs:
+        -------
+        references: pandas Series/array
+            Reference rate of each flow. Missing references are skipped.
+        buckets: pandas Series/Categorical
+            Bucket of each flow, as returned by assign_buckets. Missing
+            buckets are skipped.
+        values: pandas Series/array
+            Value of each flow.
+        """
+        references = pd.Series(np.asarray(references, dtype=object))
+        bucket_codes = np.asarray(pd.Categorical(buckets, 
+            categories=BUCKETS).codes, dtype=np.int64)
+        valid = references.notna().to_numpy() & (bucket_codes>=0)
+        references = references[valid]
+        new = pd.unique(references[~references.isin(list(self.references))])
+        if len(new):
+            self.references.update({ref: len(self.references)+i for i, ref
+                                    in enumerate(new)})
+            padding = ((0, len(new)), (0, 0))
+            self.sums = np.pad(self.sums, padding)
+            self.compensation = np.pad(self.compensation, padding)
+            self.counts = np.pad(self.counts, padding)
+        cells = references.map(self.references).to_numpy(dtype=np.int64)*\
+            len(BUCKETS)+bucket_codes[valid]
+        values = np.asarray(values, dtype=float)[valid]
+        self.counts += np.bincount(cells, minlength=self.counts.size)\
+            .reshape(self.counts.shape)
+        grouped = pd.Series(values).groupby(cells).sum()
+        chunk_sums = np.zeros(self.sums.size)
+        chunk_sums[grouped.index.to_numpy()] = grouped.to_numpy()
+        chunk_sums = chunk_sums.reshape(self.sums.shape)
+
+        # Kahan summation of the chunk sums:
+        y = chunk_sums-self.compensation
+        t = self.sums+y
+        self.compensation = np.nan_to_num((t-self.sums)-y)
+        self.sums = t
+
+    def table(self):
+        """Returns the sums by reference rate (sorted rows) and bucket
+        (BUCKETS ordered columns that have flows), with NaN where a 
+        reference has no flows in a bucket."""
+        references = sorted(self.references)
+        rows = [self.references[ref] for ref in references]
+        observed = self.counts[rows].any(axis=0) if rows else \
+            np.zeros(len(BUCKETS), dtype=bool)
+        sums = np.where(self.counts[rows]>0, self.sums[rows], np.nan)
+        columns = pd.CategoricalIndex(np.array(BUCKETS)[observed], 
+                                      categories=BUCKETS, ordered=True,
+                                      name=self.columns_name)
+        return pd.DataFrame(sums[:, observed], 
+                            index=pd.Index(references, name=self.index_name),
+                            columns=columns)
+
+def file_signature(path):
+    """Returns the modification time and the size of a file, used to
+    detect that it changed."""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _stage_property(stage, name):
+    """Creates a property of FlujosME whose value is computed by its
+    processing stage the first time it is read, and again when the
+    workbook of the stage changes."""
+    def getter(self):
+        self.run_stage(stage)
+        return self._results[name]
+    def setter(self, value):
+        self._results[name] = value
+    return property(getter, setter, 
+                    doc=f"Output of the '{stage}' stage, computed lazily.")
+
 class FlujosME(object):
     """This object contains and process the information associated to 
-    the flows of foreign currency financial instruments."""
+    the flows of foreign currency financial instruments. Each processing
+    stage runs only when one of its outputs is first needed, and again
+    if its workbook changes."""
+
+    # Processing method of each stage:
+    STAGES = {
+        'duraciones': 'process_duraciones_total',
+        'balance': 'process_balance_general_moneda',
+        'redescuentos': 'process_redescuentos',
+        'bonos': 'process_bonos',
+        'cdts': 'process_cdts'
+    }
+    READERS = {'duraciones': read_flows_by_factor}
+    # Stages whose flows can be streamed in chunks:
+    STREAMED = ['redescuentos', 'bonos', 'cdts']
+    duraciones_gap_maturity = _stage_property('duraciones',
+                                              'duraciones_gap_maturity')
+    duraciones_gap_reprecios = _stage_property('duraciones',
+                                               'duraciones_gap_reprecios')
+    bal_general = _stage_property('balance', 'bal_general')
+    redescuentos_vencimiento = _stage_property('redescuentos',
+                                               'redescuentos_vencimiento')
+    redescuentos_reprecio = _stage_property('redescuentos',
+                                            'redescuentos_reprecio')
+    bonos = _stage_property('bonos', 'bonos')
+    cdts = _stage_property('cdts', 'cdts')
 
-    def __init__(self, directory=None, ref_date=''):
+    def __init__(self, directory=None, ref_date='', parallel=True, lazy=False,
+                 cache_dir=CACHE_DIR, chunk_size=None):
         """
         Inputs:
         -------
@@ -649,6 +2574,20 @@ class FlujosME(object):
             String with the name where the flows files are located.
         ref_date: str (default='')
             String with the reference date for the analysis (YYYY-MM-DD)
+        parallel: bool (default=True)
+            If True, the five workbooks are read concurrently in a pool
+            of processes while the TRM is fetched.
+        lazy: bool (default=False)
+            If True, nothing is read at construction: each stage (and
+            the TRM) is computed the first time it is needed.
+        cache_dir: str (default=CACHE_DIR)
+            Directory where the parsed workbooks are cached, so that
+            later constructions over the same files skip the Excel
+            parsing. If None, the workbooks are always parsed.
+        chunk_size: int (default=None)
+            If given, the flows of Redescuentos, Bonos and CDTs are 
+            streamed from their workbooks in chunks of this number of 
+            rows instead of being read whole.
         """
         if isinstance(directory, type(None)):
             while True:
@@ -667,66 +2606,146 @@ class FlujosME(object):
         self.redes_path = os.path.join(directory, redescuentos_path)
         self.bonos_path = os.path.join(directory, bonos_path)
         self.cdts_path = os.path.join(directory, cdts_path)
-        self.trm = get_point_trm(ref_date=ref_date)
+        self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+        self.ref_date_string = ref_date
         self.ref_date = datetime.strptime(ref_date,"%Y-%m-%d")
+        self._results = {}
+        self._signatures = {}
+        self._trm = None
+
+        if not lazy:
+            self.load_all(parallel=parallel)
+
+    @property
+    def trm(self):
+        """TRM of the reference date, fetched the first time it is 
+        needed."""
+        if isinstance(self._trm, type(None)):
+            self._trm = get_point_trm(ref_date=self.ref_date_string)
+        return self._trm
+
+    @trm.setter
+    def trm(self, value):
+        self._trm = value
+        # The outputs are in dollars, so they are computed again:
+        self._signatures = {}
+
+    def load_all(self, parallel=True):
+        """Reads and processes all the stages.
+        
+        Inputs:
+        -------
+        parallel: bool (default=True)
+            If True, the workbooks are read concurrently in a pool of
+            processes while the TRM is fetched.
+        """
+        specs = self.read_specs()
+        signatures = {stage: file_signature(path) for stage, (path, _) in
+                      specs.items()}
+        if not isinstance(self.chunk_size, type(None)):
+            specs = {stage: spec for stage, spec in specs.items() if 
+                     stage not in self.STREAMED}
+        readers = {stage: self.READERS.get(stage) for stage in specs}
+        if parallel:
+            with ProcessPoolExecutor(max_workers=len(specs)) as executor:
+                futures = {
+                    stage: executor.submit(read_workbook, path, kwargs,
+                                           self.cache_dir, readers[stage])
+                    for stage, (path, kwargs) in specs.items()
+                }
+                self.trm
+                frames = {stage: future.result() for stage, future in 
+                          futures.items()}
+        else:
+            self.trm
+            frames = {stage: read_workbook(path, kwargs, self.cache_dir,
+                                           readers[stage]) 
+                      for stage, (path, kwargs) in specs.items()}
 
         # Process all the data inputs:
-        self.process_duraciones_total()
-        self.process_balance_general_moneda()
-        self.process_redescuentos()
-        self.process_bonos()
-        self.process_cdts()
-
-
-    def process_duraciones_total(self):
-        """Process the flows of Duraciones Total File"""
-        flujos_dur = pd.read_excel(self.dur_path,'Flujos')\
-                        .dropna(subset=['TIPO CARTERA'])
-        col_names = flujos_dur.columns.values
-        min_date = col_names[vec_is_date(col_names)].min()
-        start_dates_index = np.where(col_names==min_date)[0][0]
-        dates_len = len(col_names[start_dates_index:])
+        for stage, method in self.STAGES.items():
+            getattr(self, method)(frames.get(stage))
+            self._signatures[stage] = signatures[stage]
+
+    def run_stage(self, stage, force=False):
+        """Runs a processing stage if it hasn't run yet, if its workbook
+        changed since it ran, or if force is True."""
+        path, _ = self.read_specs()[stage]
+        signature = file_signature(path)
+        if force or self._signatures.get(stage) != signature:
+            getattr(self, self.STAGES[stage])()
+            self._signatures[stage] = signature
+
+    def invalidate(self, stage=None):
+        """Forgets the outputs of a stage (or of all the stages), so
+        that they are computed again when needed."""
+        if isinstance(stage, type(None)):
+            self._signatures = {}
+        else:
+            self._signatures.pop(stage, None)
+
+    def read_specs(self):
+        """Returns the path and the reader arguments of the workbook read
+        by each processing stage. The reader is the one in READERS, or
+        pandas.read_excel for the stages that aren't there."""
+        return {
+            'duraciones': (self.dur_path, {'sheet_name': 'Flujos'}),
+            'balance': (self.balgen_path, {'header': 6}),
+            'redescuentos': (self.redes_path, 
+                             {'sheet_name': 'Resultados ME'}),
+            'bonos': (self.bonos_path, 
+                      {'sheet_name': 'Resultados MacroDur'}),
+            'cdts': (self.cdts_path, {'sheet_name': 'Resultados Miami'})
+        }
+
+    def read_stage(self, stage):
+        """Reads the workbook of one processing stage."""
+        path, kwargs = self.read_specs()[stage]
+        return read_workbook(path, kwargs, self.cache_dir, 
+                             self.READERS.get(stage))
+
+    def process_duraciones_total(self, flujos_factor=None):
+        """Process the flows of Duraciones Total File. If the flows of the
+        'Flujos' sheet summed by factor (see read_flows_by_factor) aren't
+        given, they are read from the file."""
+        if isinstance(flujos_factor, type(None)):
+            flujos_factor = self.read_stage('duraciones')
+        col_names = flujos_factor.columns.to_numpy(dtype=object)
+        min_date = col_names[0]
+        dates_len = len(col_names)
         complete_dates = np.array([min_date+relativedelta(months=n) for n \
             in range(dates_len)])
-        match_pct = np.equal(
-            col_names[start_dates_index:],
-            complete_dates[:dates_len]
-        ).mean()
+        match_pct = np.equal(col_names, complete_dates).mean()
         print(f'Current match percentage = {match_pct*100:.2f}%')
         if match_pct<.8:
             print('Check the column names creation process.')
-            
-        col_names_final = list(col_names[:start_dates_index])+\
-            list(complete_dates)
-        flujos_dur.columns = col_names_final
 
-        flujos_factor = flujos_dur.groupby('FACTOR AJ').sum()[complete_dates]\
+        flujos_factor = flujos_factor.set_axis(complete_dates, axis=1)\
             .T.reset_index().rename(columns={
                 'index':'fecha'
             })
         flujos_factor['vencimiento'] = (flujos_factor['fecha'].dt.year-\
             min_date.year)*12+flujos_factor['fecha'].dt.month-\
             min_date.month+1
-        flujos_factor['reprecio_semestral'] = flujos_factor['vencimiento']\
-            .apply(reprecio_semestral)
-        flujos_factor['reprecio_trimestral'] = flujos_factor['vencimiento']\
-            .apply(reprecio_trimestral)
-        flujos_factor['reprecio_mensual'] = flujos_factor['vencimiento']\
-            .apply(reprecio_mensual)
+        for rule in ['semestral','trimestral','mensual','vencimiento']:
+            flujos_factor['reprecio_'+rule] = assign_buckets(
+                flujos_factor['vencimiento'], rule)
         flujos_factor['reprecio_constante'] = '1M'
-        flujos_factor['reprecio_vencimiento'] = flujos_factor['vencimiento']\
-            .apply(reprecio_vencimiento)
-        tabla_gap_maturity = flujos_factor.groupby('reprecio_vencimiento',sort=False)\
+        tabla_gap_maturity = flujos_factor.groupby('reprecio_vencimiento',
+            sort=False, observed=True)\
             [['DTF','IBR','IPC','Libor','Tasa Fija','UVR','Usura']].sum().T\
             .reset_index()
         reprecios_constantes = flujos_factor.groupby('reprecio_constante',sort=False)\
             [['UVR','Usura']].sum().T.reset_index()
-        reprecios_trimestrales = flujos_factor.groupby('reprecio_trimestral',sort=False)\
-            [['DTF','IBR']].sum().T.reset_index()
-        reprecios_semestrales = flujos_factor.groupby('reprecio_semestral',sort=False)\
-            ['Libor'].sum().to_frame().T.reset_index().rename(columns={'index':'FACTOR AJ'})
-        reprecios_mensuales = flujos_factor.groupby('reprecio_mensual',sort=False)\
-            ['IPC'].sum().to_frame().T.reset_index().rename(
+        reprecios_trimestrales = flujos_factor.groupby('reprecio_trimestral',
+            sort=False, observed=True)[['DTF','IBR']].sum().T.reset_index()
+        reprecios_semestrales = flujos_factor.groupby('reprecio_semestral',
+            sort=False, observed=True)['Libor'].sum().to_frame().T\
+            .reset_index().rename(columns={'index':'FACTOR AJ'})
+        reprecios_mensuales = flujos_factor.groupby('reprecio_mensual',
+            sort=False, observed=True)['IPC'].sum().to_frame().T\
+            .reset_index().rename(
                 columns = {'index':'FACTOR AJ'}
                 )
         tabla_gap_reprecios = reprecios_mensuales.merge(reprecios_constantes,
@@ -747,8 +2766,9 @@ class FlujosME(object):
         self.duraciones_gap_maturity = tabla_gap_maturity
         self.duraciones_gap_reprecios = tabla_gap_reprecios
     
-    def process_balance_general_moneda(self):
-        """Process the general balance by currency"""
+    def process_balance_general_moneda(self, bal_monedas=None):
+        """Process the general balance by currency. If the sheet isn't
+        given, it is read from the file."""
         # Define accounts:
         i = [13,1315]
         oa = [11,12,16,18,19]
@@ -756,8 +2776,9 @@ class FlujosME(object):
         op = [2122,2117,2116,22,25,27,3]
 
         # Import information
-        bal_monedas = pd.read_excel(self.balgen_path, header=6)\
-            [['Cuenta','Total MX']].set_index('Cuenta')
+        if isinstance(bal_monedas, type(None)):
+            bal_monedas = self.read_stage('balance')
+        bal_monedas = bal_monedas[['Cuenta','Total MX']].set_index('Cuenta')
         
         inversiones = (bal_monedas.loc[13,'Total MX']-bal_monedas\
             .loc[1315,'Total MX'])*1e-6/self.trm
@@ -772,166 +2793,201 @@ class FlujosME(object):
             'Otros Pasivos': otros_pasivos
         }
 
-    def process_redescuentos(self):
-        """Process redecuentos information"""
-        redescuentos = pd.read_excel(self.redes_path, 'Resultados ME')
-        redescuentos['days'] = (redescuentos['Periodos de Pago']-self.ref_date)\
-            .dt.days+1
-        mask_libor_1m = redescuentos['Tasa Referencia']=='LIBOR1M'
-        mask_libor_3m = redescuentos['Tasa Referencia']=='LIBOR3M'
-        mask_libor_6m = redescuentos['Tasa Referencia']=='LIBOR6M'
-        redescuentos.loc[mask_libor_1m, 'days_to_reprice'] = redescuentos\
-            .loc[mask_libor_1m, 'days'].apply(lambda x: days_to_reprice(x,'1M'))
-        redescuentos.loc[mask_libor_3m, 'days_to_reprice'] = redescuentos\
-            .loc[mask_libor_3m, 'days'].apply(lambda x: days_to_reprice(x,'3M'))
-        redescuentos.loc[mask_libor_6m, 'days_to_reprice'] = redescuentos\
-            .loc[mask_libor_6m, 'days'].apply(lambda x: days_to_reprice(x,'6M'))
-        redescuentos['Reprecio Vencimiento'] = redescuentos['days']\
-            .apply(days_to_reference)
-        redescuentos['Reprecio'] = redescuentos['days_to_reprice'].apply(
-            days_to_reference
-        )
-        redescuentos['Flujos Capital USD'] = redescuentos['Flujos Capital']/\
-            self.trm
-        order = sort_colnames(
-            col_names = redescuentos['Reprecio Vencimiento'].unique(),
-            buckets = BUCKETS
-        )
+    def read_chunks(self, stage, frame=None):
+        """Returns the flows of a stage as an iterable of chunks: the 
+        given frame, the whole sheet or, if chunk_size is set, the sheet
+        streamed in chunks of FLOW_COLUMNS."""
+        if not isinstance(frame, type(None)):
+            return [frame]
+        if isinstance(self.chunk_size, type(None)):
+            return [self.read_stage(stage)]
+        path, kwargs = self.read_specs()[stage]
+        return iter_sheet_chunks(path, kwargs['sheet_name'], FLOW_COLUMNS,
+                                 self.chunk_size)
+
+    def flow_days(self, flows):
+        """Days from the reference date to the payment of each flow."""
+        return (excel_serial_to_datetime(flows['Periodos de Pago'])-\
+            self.ref_date).dt.days+1
+
+    def process_redescuentos(self, redescuentos=None):
+        """Process redecuentos information. If the 'Resultados ME' sheet
+        isn't given, it is read from the file."""
+        rep_redescuentos_vencimiento = GapAccumulator(
+            columns_name='Reprecio Vencimiento')
+        reprecios = GapAccumulator()
+        for redescuentos in self.read_chunks('redescuentos', redescuentos):
+            days = self.flow_days(redescuentos)
+            days_to_reprice = vec_days_to_reprice(
+                days, redescuentos['Tasa Referencia'])
+            flujos_usd = redescuentos['Flujos Capital']/self.trm
+            rep_redescuentos_vencimiento.add(
+                redescuentos['Tasa Referencia'], assign_buckets(days),
+                flujos_usd)
+            reprecios.add(redescuentos['Tasa Referencia'], 
+                          assign_buckets(days_to_reprice), flujos_usd)
 
         # Maturity gap:
-        rep_redescuentos_vencimiento = redescuentos.groupby(
-            ['Tasa Referencia','Reprecio Vencimiento']).sum()['Flujos Capital USD']\
-                .reset_index().pivot(
-                index = 'Tasa Referencia',
-                columns = 'Reprecio Vencimiento',
-                values = 'Flujos Capital USD'
-            )[order]
+        rep_redescuentos_vencimiento = rep_redescuentos_vencimiento.table()
         rep_redescuentos_vencimiento.loc['LIBOR',:] = rep_redescuentos_vencimiento\
             .sum(axis=0)*-1e-6
         self.redescuentos_vencimiento = rep_redescuentos_vencimiento
 
         # Reprice gap:
-        reprecios = redescuentos.groupby(['Tasa Referencia','Reprecio'])\
-            .sum()['Flujos Capital USD'].reset_index().pivot(
-                index = 'Tasa Referencia',
-                columns = 'Reprecio',
-                values = 'Flujos Capital USD'
-            )*-1e-6
-        self.redescuentos_reprecio = reprecios
-
-    def process_bonos(self):
-        """Process bonos flows"""
-        bonos = pd.read_excel(self.bonos_path,sheet_name='Resultados MacroDur')
-        bonos['days'] = (bonos['Periodos de Pago']-self.ref_date).dt.days+1
-        bonos['Reprecio'] = bonos['days'].apply(days_to_reference)
-        bonos['Flujos Capital USD'] = bonos['Flujos Capital']*-1e-6/self.trm
-        rep_bonos = bonos.groupby(['Tasa Referencia','Reprecio']).sum()\
-            ['Flujos Capital USD'].reset_index().pivot(
-                index = 'Tasa Referencia',
-                columns = 'Reprecio',
-                values = 'Flujos Capital USD'
-            )
-        rep_bonos = rep_bonos[sort_colnames(rep_bonos.columns.values, BUCKETS)]
-        self.bonos = rep_bonos
-
-    def process_cdts(self):
-        """Process CDTs flows"""
-        cdts = pd.read_excel(self.cdts_path, 'Resultados Miami')
-        cdts['Periodos de Pago'] = cdts['Periodos de Pago']\
-            .apply(from_float_to_date)
-        cdts['days'] = (cdts['Periodos de Pago']-self.ref_date).dt.days+1
-        cdts['Reprecio'] = cdts['days'].apply(days_to_reference)
-        cdts['Flujos Capital USD'] = cdts['Flujos Capital']*-1e-6/self.trm
-        rep_cdts = cdts.groupby(['Tasa Referencia','Reprecio']).sum()\
-            ['Flujos Capital USD'].reset_index().pivot(
-                index = 'Tasa Referencia',
-                columns = 'Reprecio',
-                values = 'Flujos Capital USD'
-            )
-        rep_cdts = rep_cdts[sort_colnames(rep_cdts.columns.values, BUCKETS)]
+        self.redescuentos_reprecio = reprecios.table()*-1e-6
+
+    def process_bonos(self, bonos=None):
+        """Process bonos flows. If the 'Resultados MacroDur' sheet isn't
+        given, it is read from the file."""
+        rep_bonos = GapAccumulator()
+        for bonos in self.read_chunks('bonos', bonos):
+            rep_bonos.add(bonos['Tasa Referencia'], 
+                          assign_buckets(self.flow_days(bonos)),
+                          bonos['Flujos Capital']*-1e-6/self.trm)
+        self.bonos = rep_bonos.table()
+
+    def process_cdts(self, cdts=None):
+        """Process CDTs flows. If the 'Resultados Miami' sheet isn't 
+        given, it is read from the file."""
+        rep_cdts = GapAccumulator()
+        for cdts in self.read_chunks('cdts', cdts):
+            rep_cdts.add(cdts['Tasa Referencia'], 
+                         assign_buckets(self.flow_days(cdts)),
+                         cdts['Flujos Capital']*-1e-6/self.trm)
+        rep_cdts = rep_cdts.table()
         rep_cdts.loc['Total',:] = rep_cdts.sum(axis=0)
         self.cdts = rep_cdts
     
-    def get_maturity_gap(self):
-        """Consolidates the flows information by maturity gap from
-        Duraciones, Balance General por Monedas, Redescuentos, Bonos and
-        CDTs.
-        """
-        Rubros = ['Cartera LIBOR', 'Inversiones', 'Otros Activos',
-                  'Depósitos Vista', 'Corresponsales LIBOR','Bonos ME TF', 
-                  'CDT TF', 'Otros Pasivos']
-        Moneda = ['USD','','ML y USD','ML y USD','USD', 'USD', 'USD', 
-                  'ML y USD']
-        maturity_gap_total = pd.DataFrame(columns=['N/M']+BUCKETS)
-        maturity_gap_total = maturity_gap_total.merge(
-            self.duraciones_gap_maturity[self.duraciones_gap_maturity['FACTOR AJ']=='Libor']\
-                .drop(columns='FACTOR AJ'),
-            on = list(self.duraciones_gap_maturity.columns.values)[1:],
-            how = 'outer'
-        )
-        maturity_gap_total.loc[1, 'N/M'] = self.bal_general['Inversiones']
-        maturity_gap_total.loc[2, 'N/M'] = self.bal_general['Otros Activos']
-        maturity_gap_total.loc[3, 'N/M'] = self.bal_general['Depósitos Vista']
-        maturity_gap_total = maturity_gap_total.merge(
-            self.redescuentos_vencimiento.loc['LIBOR'].to_frame().T,
-            on = list(self.redescuentos_vencimiento.columns.values),
-            how = 'outer'
-        )
-        maturity_gap_total = maturity_gap_total.merge(
-            self.bonos.loc['ME'].to_frame().T,
-            on = list(self.bonos.columns.values),
-            how = 'outer'
-        )
-        maturity_gap_total = maturity_gap_total.merge(
-            self.cdts.loc['Total'].to_frame().T,
-            on = list(self.cdts.columns.values),
-            how = 'outer'
-        )
-        maturity_gap_total.loc[7, 'N/M'] = self.bal_general['Otros Pasivos']
-        original_names = list(maturity_gap_total.columns.values)
-        maturity_gap_total['Rubro'] = Rubros
-        maturity_gap_total['Moneda'] = Moneda
+    def get_gaps_by_date(self, ref_dates, trms=None, with_source=False):
+        """Computes the maturity and repricing gaps for several reference
+        dates. The workbooks are parsed once, and the days, buckets and
+        USD conversion of Redescuentos, Bonos and CDTs are computed for 
+        all the dates at once.
+        
+        Inputs:
+        -------
+        ref_dates: list
+            Reference dates in format "YYYY-MM-DD".
+        trms: dict (default = None)
+            TRM by reference date. If None, the TRM series is fetched 
+            once for all the dates.
+        with_source: bool (default = False)
+            If True, the gaps have a 'Fuente' index level.
         
-        maturity_gap_total = maturity_gap_total[original_names+['Rubro','Moneda']]
+        Outputs:
+        --------
+        maturity_gaps: pandas DataFrame
+            Maturity gaps stacked by 'Fecha Corte'.
+        repricing_gaps: pandas DataFrame
+            Repricing gaps stacked by 'Fecha Corte'.
+        """
+        ref_dates = list(ref_dates)
+        if isinstance(trms, type(None)):
+            oldest = min(datetime.strptime(d, '%Y-%m-%d') for d in ref_dates)
+            trm_series = get_trm_series(limit=(datetime.today()-oldest).days)
+            trms = {d: trm_series.loc[datetime.strptime(d, '%Y-%m-%d'), 
+                                      'valor'] for d in ref_dates}
+        frames = {stage: self.read_stage(stage) for stage in self.STAGES}
+        signatures = {stage: file_signature(path) for stage, (path, _) in 
+                      self.read_specs().items()}
+        
+        redes_refs, redes_maturity, _ = bucket_flows_by_date(
+            frames['redescuentos'], ref_dates)
+        _, redes_reprice, redes_present = bucket_flows_by_date(
+            frames['redescuentos'], ref_dates, reprice=True)
+        bonos_refs, bonos_sums, _ = bucket_flows_by_date(frames['bonos'],
+                                                         ref_dates)
+        cdts_refs, cdts_sums, _ = bucket_flows_by_date(frames['cdts'],
+                                                       ref_dates)
+
+        maturity_gaps, repricing_gaps = dict(), dict()
+        for i, ref_date in enumerate(ref_dates):
+            flujos = copy.copy(self)
+            flujos.ref_date_string = ref_date
+            flujos.ref_date = datetime.strptime(ref_date, '%Y-%m-%d')
+            flujos._results = dict()
+            flujos.trm = trm = trms[ref_date]
+            flujos.process_duraciones_total(frames['duraciones'])
+            flujos.process_balance_general_moneda(frames['balance'])
+
+            redescuentos_vencimiento = pd.DataFrame(
+                redes_maturity[i]/trm, index=redes_refs, columns=BUCKETS)
+            redescuentos_vencimiento.loc['LIBOR',:] = redescuentos_vencimiento\
+                .sum(axis=0)*-1e-6
+            flujos.redescuentos_vencimiento = redescuentos_vencimiento
+            flujos.redescuentos_reprecio = pd.DataFrame(
+                redes_reprice[i]*-1e-6/trm, index=redes_refs, 
+                columns=BUCKETS)[redes_present[i]]
+            flujos.bonos = pd.DataFrame(bonos_sums[i]*-1e-6/trm, 
+                                        index=bonos_refs, columns=BUCKETS)
+            cdts = pd.DataFrame(cdts_sums[i]*-1e-6/trm, index=cdts_refs,
+                                columns=BUCKETS)
+            cdts.loc['Total',:] = cdts.sum(axis=0)
+            flujos.cdts = cdts
+            flujos._signatures = dict(signatures)
 
-        return maturity_gap_total.fillna(0).set_index(['Rubro','Moneda'])
+            maturity_gaps[ref_date] = flujos.get_maturity_gap(with_source)
+            repricing_gaps[ref_date] = flujos.get_repricing_gap(with_source)
+        return (pd.concat(maturity_gaps, names=['Fecha Corte']),
+                pd.concat(repricing_gaps, names=['Fecha Corte']))
 
-    def get_repricing_gap(self):
+    def gap_source(self, stage):
+        """Returns the name of the workbook read by a processing stage."""
+        path, _ = self.read_specs()[stage]
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def get_maturity_gap(self, with_source=False):
+        """Consolidates the flows information by maturity gap from
+        Duraciones, Balance General por Monedas, Redescuentos, Bonos and
+        CDTs. If with_source is True, the index has a 'Fuente' level
+        with the workbook each row comes from.
+        """
+        dur = self.duraciones_gap_maturity.set_index('FACTOR AJ')
+        bal = {rubro: pd.Series({'N/M': value}) for rubro, value in 
+               self.bal_general.items()}
+        rows = [
+            (('Cartera LIBOR', 'USD', 'duraciones'), dur.loc['Libor']),
+            (('Inversiones', '', 'balance'), bal['Inversiones']),
+            (('Otros Activos', 'ML y USD', 'balance'), bal['Otros Activos']),
+            (('Depósitos Vista', 'ML y USD', 'balance'), 
+             bal['Depósitos Vista']),
+            (('Corresponsales LIBOR', 'USD', 'redescuentos'), 
+             self.redescuentos_vencimiento.loc['LIBOR']),
+            (('Bonos ME TF', 'USD', 'bonos'), self.bonos.loc['ME']),
+            (('CDT TF', 'USD', 'cdts'), self.cdts.loc['Total']),
+            (('Otros Pasivos', 'ML y USD', 'balance'), bal['Otros Pasivos'])
+        ]
+        rows = [((rubro, moneda, self.gap_source(stage)), row) for 
+                (rubro, moneda, stage), row in rows]
+        maturity_gap_total = assemble_gap(rows, ['Rubro','Moneda','Fuente'])
+        if not with_source:
+            maturity_gap_total = maturity_gap_total.droplevel('Fuente')
+        return maturity_gap_total
+
+    def get_repricing_gap(self, with_source=False):
         """Consolidates the flows information by repricing gap from
         Duraciones, Balance General por Monedas, Redescuentos, Bonos and
-        CDTs.
+        CDTs. If with_source is True, the index has a 'Fuente' level
+        with the workbook each row comes from.
         """
-        reprice_gap_libor = pd.DataFrame(columns = ['N/M']+BUCKETS)
-        for term in reprice_gap_libor.columns.values:
-            try:
-                mask = self.duraciones_gap_reprecios['FACTOR AJ']=='Libor'
-                reprice_gap_libor.loc['Cartera LIBOR6M', term] = self\
-                    .duraciones_gap_reprecios.loc[mask, term].values[0]
-            except: continue
-        
-        for factor in self.bal_general.keys():
-            reprice_gap_libor.loc[factor,'N/M'] = self.bal_general[factor]
+        dur = self.duraciones_gap_reprecios.set_index('FACTOR AJ')
+        rows = [(('Cartera LIBOR6M', 'duraciones'), dur.loc['Libor'])]
+        rows += [((factor, 'balance'), pd.Series({'N/M': value})) for 
+                 factor, value in self.bal_general.items()]
         
         referencias_libor = ['LIBOR1M','LIBOR3M','LIBOR6M']
-        for libor in referencias_libor:
-            for term in reprice_gap_libor.columns.values:
-                try:
-                    reprice_gap_libor.loc['Corresponsales '+libor, term] = \
-                        self.redescuentos_reprecio.loc[libor,term]
-                except: continue
-        
-        for term in reprice_gap_libor.columns.values:
-            try:
-                reprice_gap_libor.loc['Bonos ME TF', term] = self.bonos\
-                    .loc['ME',term]
-            except: continue
-
-        for term in reprice_gap_libor.columns.values:
-            try:
-                reprice_gap_libor.loc['CDT TF', term] = self.cdts.loc['Total',term]
-            except: continue
-        
-
+        referencias_libor += [ref for ref in self.redescuentos_reprecio.index
+                              if ref not in referencias_libor]
+        rows += [(('Corresponsales '+libor, 'redescuentos'), 
+                  self.redescuentos_reprecio.loc[libor]) for libor in 
+                 referencias_libor if libor in self.redescuentos_reprecio.index]
+        rows += [(('Bonos ME TF', 'bonos'), self.bonos.loc['ME']),
+                 (('CDT TF', 'cdts'), self.cdts.loc['Total'])]
+        rows = [((rubro, self.gap_source(stage)), row) for (rubro, stage), 
+                row in rows]
+        reprice_gap_libor = assemble_gap(rows, [None, 'Fuente'])
+        if not with_source:
+            reprice_gap_libor = reprice_gap_libor.droplevel('Fuente')
         return reprice_gap_libor
 
 